@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from plctestbench.database_manager import SQLITE_CHUNK_SIZE, SQLITE_TIMEOUT, _chunks, _placeholders
+
+ARTIFACT_STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS refs (key TEXT NOT NULL, owner TEXT NOT NULL, PRIMARY KEY (key, owner));
+CREATE INDEX IF NOT EXISTS refs_owner ON refs (owner);
+'''
+
+class ArtifactStore(object):
+    '''
+    This class stores the files of the nodes in a flat, content-addressed
+    folder instead of the folder tree of the run: the file of a node is
+    named after a key combining its id, which identifies the node and all
+    its ancestors, with the hash of the content of its original track (see
+    Node._get_store_key), so the same node of the same track is stored once
+    even when it is computed from different root folders. The files are
+    spread over two levels of shard folders, named after the last digits of
+    the key, to keep the size of the folders bounded.
+
+    Each database using the store (the owner) references the files of its
+    nodes in an SQLite file in the store folder. The references are removed
+    when the nodes are deleted from the database, and gc deletes the files
+    that are not referenced by any owner.
+
+        Inputs:
+            folder: the folder of the store.
+            owner:  the identifier of the database using the store.
+            links:  whether a symbolic link to the file of each computed
+                    node is created at its path in the folder tree, for the
+                    tools relying on the previous layout.
+    '''
+    def __init__(self, folder, owner: str, links: bool = False) -> None:
+        self.folder = Path(folder).resolve()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.owner = owner
+        self.links = links
+        self.connection = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # The connection cannot be shared with forked processes
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.folder / "refs.sqlite3", timeout=SQLITE_TIMEOUT, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(ARTIFACT_STORE_SCHEMA)
+            self.pid = os.getpid()
+        return self.connection
+
+    def get_path(self, key: str, extension: str) -> str:
+        '''
+        This function returns the path of the file with the given key.
+
+            Inputs:
+                key:        the key of the file.
+                extension:  the extension of the file, dot included.
+        '''
+        shard = key.zfill(4)
+        return str(self.folder / shard[-2:] / shard[-4:-2] / (key + extension))
+
+    def allocate(self, key: str, extension: str, legacy_path: str | None = None) -> str:
+        '''
+        This function references the file with the given key, creates its
+        shard folder and returns its path. The reference is added before the
+        shard folder is created and the file is written, so gc never deletes
+        a file being written or its folder.
+
+            Inputs:
+                key:            the key of the file.
+                extension:      the extension of the file, dot included.
+                legacy_path:    the path of the file in the folder tree,
+                                where a link is created if links is True.
+        '''
+        filepath = self.get_path(key, extension)
+        self.add_reference(key)
+        # The folder may have been removed by gc since the last allocation
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if self.links and legacy_path is not None:
+            if os.path.lexists(legacy_path):
+                os.remove(legacy_path)
+            os.symlink(filepath, legacy_path)
+        return filepath
+
+    def contains(self, filepath) -> bool:
+        '''
+        This function returns True if the given file is in the store.
+        '''
+        return Path(filepath).resolve().is_relative_to(self.folder)
+
+    @staticmethod
+    def get_key(filepath) -> str:
+        '''
+        This function returns the key of a file in the store.
+        '''
+        return Path(filepath).name.split('.')[0]
+
+    def add_reference(self, key: str) -> None:
+        with self.lock:
+            connection = self._get_connection()
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO refs (key, owner) VALUES (?, ?)", (key, self.owner))
+
+    def remove_reference(self, key: str) -> None:
+        with self.lock:
+            connection = self._get_connection()
+            with connection:
+                connection.execute("DELETE FROM refs WHERE key = ? AND owner = ?", (key, self.owner))
+
+    def remove_owner(self) -> None:
+        '''
+        This function removes all the references of the owner, e.g. when its
+        database is deleted.
+        '''
+        with self.lock:
+            connection = self._get_connection()
+            with connection:
+                connection.execute("DELETE FROM refs WHERE owner = ?", (self.owner,))
+
+    def gc(self) -> tuple:
+        '''
+        This function deletes the files of the store that are not referenced
+        by any owner, and the shard folders left empty. It returns the number
+        of deleted files and the bytes freed.
+
+        The write lock of the references is held from the check of the
+        references to the deletion of the files: a reference added at the
+        same time by allocate, in this or in another process, is either
+        found by the check or added once the files are deleted.
+        '''
+        files = {}
+        for shard in self.folder.glob("*/*"):
+            if shard.is_dir():
+                for filepath in shard.iterdir():
+                    files.setdefault(self.get_key(filepath), []).append(filepath)
+
+        deleted_files, freed_bytes = 0, 0
+        with self.lock:
+            connection = self._get_connection()
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                keys = list(files.keys())
+                referenced = set()
+                for chunk in _chunks(keys, SQLITE_CHUNK_SIZE):
+                    rows = connection.execute("SELECT DISTINCT key FROM refs WHERE key IN (" + _placeholders(chunk) + ")", chunk)
+                    referenced.update(row[0] for row in rows)
+                for key, filepaths in files.items():
+                    if key in referenced:
+                        continue
+                    for filepath in filepaths:
+                        try:
+                            size = filepath.stat().st_size
+                            filepath.unlink()
+                        except FileNotFoundError:
+                            continue
+                        deleted_files += 1
+                        freed_bytes += size
+
+                # The folders of the referenced files not written yet are kept
+                rows = connection.execute("SELECT DISTINCT substr('0000' || key, -4) FROM refs")
+                referenced_shards = set(row[0] for row in rows)
+                for shard in self.folder.glob("*/*"):
+                    if shard.is_dir() and shard.name + shard.parent.name not in referenced_shards and not any(shard.iterdir()):
+                        shard.rmdir()
+                for shard in self.folder.glob("*"):
+                    if shard.is_dir() and not any(shard.iterdir()):
+                        shard.rmdir()
+        return deleted_files, freed_bytes
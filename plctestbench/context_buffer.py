@@ -0,0 +1,49 @@
+import numpy as np
+
+class ContextBuffer(object):
+    '''
+    This class stores the last samples processed by a PLC algorithm.
+    The samples are appended to a buffer twice as long as the context,
+    which is compacted only when it is full, so that appending a packet
+    costs on average as much as copying the packet itself and the context
+    is always available as a contiguous view.
+
+        Inputs:
+            context:    the initial content of the context. Its length
+                        sets the length of the context.
+    '''
+    def __init__(self, context: np.ndarray) -> None:
+        self.length = np.shape(context)[0]
+        self.buffer = np.zeros((2 * self.length,) + np.shape(context)[1:], dtype=context.dtype)
+        self.buffer[:self.length] = context
+        self.end = self.length
+
+    def get(self) -> np.ndarray:
+        '''
+        This function returns a view of the last samples of the context.
+        '''
+        return self.buffer[self.end - self.length:self.end]
+
+    def push(self, samples: np.ndarray) -> None:
+        '''
+        This function appends the given samples to the context, discarding
+        the oldest ones.
+        '''
+        n_samples = np.shape(samples)[0]
+        if self.length == 0 or n_samples == 0:
+            return
+        if n_samples >= self.length:
+            self.buffer[:self.length] = samples[-self.length:]
+            self.end = self.length
+        elif self.end + n_samples <= len(self.buffer):
+            self.buffer[self.end:self.end + n_samples] = samples
+            self.end += n_samples
+        else:
+            # The samples may be a view of the context itself (e.g. the last
+            # packet repeated by LastPacketPLC): copy them before compacting.
+            if np.shares_memory(samples, self.buffer):
+                samples = samples.copy()
+            kept = self.length - n_samples
+            self.buffer[:kept] = self.buffer[self.end - kept:self.end]
+            self.buffer[kept:self.length] = samples
+            self.end = self.length
@@ -1,11 +1,72 @@
+import os
 import typing
+import logging
 import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from anytree import LevelOrderIter, search
 from .path_manager import PathManager
-from .database_manager import MongoDatabaseManager
+from .database_manager import MongoDatabaseManager, SQLiteDatabaseManager, TinyDBDatabaseManager
 from .node import ReconstructedTrackNode, LostSamplesMaskNode, Node, OriginalTrackNode, OutputAnalysisNode
+from .file_wrapper import FileWrapper
+from .planner import ExecutionPlan, plan_execution
+from .artifact_store import ArtifactStore
 from .settings import Settings
-from .utils import get_class, compute_hash, progress_monitor
+from .utils import get_class, compute_hash
+from .progress import ProgressEvent, TqdmProgressSink, as_progress_sink, NODE_STARTED, NODE_FINISHED
+from . import write_behind
+
+# DataManager instance inherited by the worker processes of the pool
+# used by DataManager._run_parallel.
+_process_data_manager = None
+
+def _init_process(data_manager) -> None:
+    '''
+    This function is executed once in every worker process of the pool.
+    The processes are forked, so the data manager (and the whole tree)
+    is inherited without being pickled.
+    '''
+    global _process_data_manager
+    _process_data_manager = data_manager
+    # The client and the write-behind thread of the main process must not be
+    # used by the worker processes
+    data_manager.database_manager.reset_after_fork()
+    write_behind.reset_after_fork()
+
+def _run_node(address: tuple, ancestor_paths: list, root_hash: int | None = None) -> tuple:
+    '''
+    This function runs a single node inside a worker process.
+
+        Inputs:
+            address:        the position of the node in the forest, see
+                            DataManager._get_node_address.
+            ancestor_paths: the paths of the files produced by the ancestors
+                            of the node, in the same order as node.ancestors.
+            root_hash:      the hash of the original track, used for the keys
+                            of the artifact store, see Node._get_store_key.
+                            The root may have been run after the process was
+                            forked, so it is not hashed again.
+    '''
+    node = _process_data_manager._get_node(address)
+    if root_hash is not None and node.root.get_file().hash is None:
+        node.root.get_file().hash = root_hash
+    loaded = []
+    for ancestor, path in zip(node.ancestors, ancestor_paths):
+        if ancestor.get_file() is None:
+            ancestor.set_file(FileWrapper.from_path(path, lazy=True))
+            loaded.append(ancestor)
+    try:
+        node.run()
+        write_behind.flush()
+        _process_data_manager.database_manager.flush()
+        # Only the path and the hash of the file are returned: the parent
+        # reads the data lazily, as for the nodes loaded from the database
+        return node.get_file().get_path(), node.get_file().hash, node.persistent, node.metrics
+    finally:
+        # The forked tree is reused by the following tasks: drop the data
+        # so that the memory of the worker process does not keep growing.
+        for loaded_node in loaded + [node]:
+            loaded_node.set_file(None)
 
 
 class DataManager(object):
@@ -26,12 +87,41 @@ class DataManager(object):
         db_username = testbench_settings['db_username'] if 'db_username' in testbench_settings.keys() else None
         db_password = testbench_settings['db_password'] if 'db_password' in testbench_settings.keys() else None
         db_conn_string = testbench_settings['db_conn_string'] if 'db_conn_string' in testbench_settings.keys() else None
-        self.progress_monitor = testbench_settings['progress_monitor'] if 'progress_monitor' in testbench_settings.keys() else progress_monitor
-        
-        self.path_manager = PathManager(root_folder)
-        self.database_manager = MongoDatabaseManager(ip=db_ip, port=db_port, username=db_username, password=db_password, user=self.user, conn_string=db_conn_string)
+        self.progress_monitor = as_progress_sink(testbench_settings['progress_monitor']) if 'progress_monitor' in testbench_settings.keys() else TqdmProgressSink()
+        self.processes = int(testbench_settings['processes']) if 'processes' in testbench_settings.keys() else 1
+        self.paranoid = bool(testbench_settings['paranoid']) if 'paranoid' in testbench_settings.keys() else False
+        self.write_behind = bool(testbench_settings['write_behind']) if 'write_behind' in testbench_settings.keys() else False
+        db_batch_size = int(testbench_settings['db_batch_size']) if 'db_batch_size' in testbench_settings.keys() else 1000
+        db_backend = testbench_settings['db_backend'] if 'db_backend' in testbench_settings.keys() else 'mongodb'
+        db_path = testbench_settings['db_path'] if 'db_path' in testbench_settings.keys() else os.path.join(str(root_folder), 'database')
+        folder_threads = int(testbench_settings['folder_threads']) if 'folder_threads' in testbench_settings.keys() else 1
+        artifact_store = testbench_settings['artifact_store'] if 'artifact_store' in testbench_settings.keys() else None
+        artifact_links = bool(testbench_settings['artifact_links']) if 'artifact_links' in testbench_settings.keys() else False
+
+        self.path_manager = PathManager(root_folder, folder_threads)
+        if db_backend == 'mongodb':
+            self.database_manager = MongoDatabaseManager(ip=db_ip, port=db_port, username=db_username, password=db_password, user=self.user, conn_string=db_conn_string, batch_size=db_batch_size)
+        elif db_backend == 'sqlite':
+            self.database_manager = SQLiteDatabaseManager(user=self.user, conn_string=db_path, batch_size=db_batch_size)
+        elif db_backend == 'tinydb':
+            self.database_manager = TinyDBDatabaseManager(user=self.user, conn_string=db_path, batch_size=db_batch_size)
+        else:
+            raise ValueError("Unknown database backend: " + str(db_backend))
+        if db_backend == 'tinydb' and self.processes > 1:
+            # Every process would write its own copy of the TinyDB file
+            raise ValueError("The tinydb backend does not support processes > 1")
+        self.artifact_store = None
+        if artifact_store:
+            artifact_folder = os.path.join(str(root_folder), 'artifacts') if artifact_store is True else artifact_store
+            # The references are owned by the database of the user, without the credentials of the connection string
+            database_location = os.path.abspath(db_path) if db_backend != 'mongodb' else str(compute_hash(db_conn_string if db_conn_string is not None else str(db_ip) + ':' + str(db_port)))
+            owner = db_backend + ':' + database_location + ':' + self.user['email']
+            self.artifact_store = ArtifactStore(artifact_folder, owner, artifact_links)
+            self.database_manager.artifact_store = self.artifact_store
         self.root_nodes = []
         self.worker_classes = []
+        self.run = None
+        self.plan = None
         self.node_classes = [
             OriginalTrackNode,
             LostSamplesMaskNode,
@@ -42,15 +132,36 @@ class DataManager(object):
             for node_class, i in zip(self.node_classes, range(len(self.node_classes) - 1)):
                 self.database_manager.add_node({"child_collection": self.node_classes[i + 1].__name__}, node_class.__name__)
 
-    def run_testbench(self) -> None:
+    def run_testbench(self, subtrees: list | None = None) -> None:
         '''
         Run the testbench.
+
+            Inputs:
+                subtrees:   the root nodes of the subtrees to be run, see
+                            add_workers. Their ancestors are loaded from
+                            the database (or computed) first. By default
+                            all the trees are run.
         '''
+        if subtrees is None:
+            subtrees = self.root_nodes
         self._set_run_status('RUNNING')
         try:
-            for root_node in self.progress_monitor(self)(self.root_nodes, desc="Audio Tracks"):
-                for node in LevelOrderIter(root_node):
-                    node.run()
+            self.plan_execution(subtrees)
+            logging.getLogger('plctestbench').info(str(self.plan))
+            if self.processes > 1:
+                self._run_parallel(subtrees)
+            else:
+                desc = "Audio Tracks" if subtrees is self.root_nodes else "Subtrees"
+                for subtree in self.progress_monitor(self)(subtrees, desc=desc):
+                    if self.plan.is_pruned(subtree):
+                        continue
+                    self._run_ancestors(subtree)
+                    for node in LevelOrderIter(subtree, stop=self.plan.is_pruned):
+                        self._run_with_events(node)
+                # Make sure that the files written in the background are on disk
+                for node in self.get_nodes_by_depth(2):
+                    if node.get_file() is not None:
+                        node.get_file().wait()
         except KeyboardInterrupt:
             print("Simulation interrupted by user.")
             return
@@ -58,6 +169,156 @@ class DataManager(object):
             self._set_run_status('FAILED')
         self._set_run_status('COMPLETED')
 
+    def plan_execution(self, subtrees: list | None = None, estimate: bool = False) -> ExecutionPlan:
+        '''
+        This function retrieves the documents of the nodes of the given
+        subtrees (all the trees by default) and resolves which ones are
+        already materialized before running them, see planner.plan_execution.
+        When estimate is True, the CPU time and the disk usage of the nodes
+        to compute are estimated too, see ExecutionPlan.estimate.
+        '''
+        if subtrees is None:
+            subtrees = self.root_nodes
+        self._prefetch_nodes(subtrees)
+        self.plan = plan_execution(subtrees, self.database_manager, self.paranoid)
+        if estimate:
+            self.plan.estimate(self.database_manager.get_worker_statistics())
+        return self.plan
+
+    def get_worker_throughput(self) -> dict:
+        '''
+        This function returns the throughput of each worker class, in samples
+        per second of wall time, measured on all the nodes computed so far
+        that are stored in the database.
+        '''
+        totals = {}
+        for (worker, _), group in self.database_manager.get_worker_statistics().items():
+            total = totals.setdefault(worker, [0., 0])
+            total[0] += group["wall_time"] or 0.
+            total[1] += group["num_samples"] or 0
+        return {worker: num_samples / wall_time for worker, (wall_time, num_samples) in totals.items() if wall_time > 0}
+
+    def _prefetch_nodes(self, subtrees: list) -> None:
+        '''
+        This function retrieves the documents of all the nodes of the given
+        subtrees, and of their ancestors, from the database at once, instead
+        of one query per node.
+        '''
+        node_ids = {}
+        for subtree in subtrees:
+            for node in subtree.ancestors + tuple(LevelOrderIter(subtree)):
+                node_ids.setdefault(type(node).__name__, []).append(node.get_id())
+        self.database_manager.prefetch_nodes(node_ids)
+
+    def _run_ancestors(self, subtree: Node) -> None:
+        '''
+        This function runs the ancestors of a subtree that have not been
+        run yet, so that their files are available to the subtree.
+        '''
+        for ancestor in subtree.ancestors:
+            if ancestor.get_file() is None:
+                self._run_with_events(ancestor)
+
+    def _run_with_events(self, node: Node) -> None:
+        '''
+        This function runs a node in the main process and passes the events
+        of its start and of its end to the progress sink.
+        '''
+        self.progress_monitor.emit(ProgressEvent(NODE_STARTED, node))
+        node.run()
+        self.progress_monitor.emit(ProgressEvent(NODE_FINISHED, node, node.metrics))
+
+    def _run_parallel(self, subtrees: list) -> None:
+        '''
+        This function runs the given subtrees on a pool of worker processes.
+        The root nodes (and the ancestors of the subtrees) are run in the
+        main process, every other node is submitted to the pool as soon as
+        its parent has finished, so that sibling subtrees are computed
+        concurrently. The events of the nodes run by the pool are emitted
+        by the main process: a node is started when it is submitted.
+        '''
+        total = sum(len(tuple(LevelOrderIter(subtree, stop=self.plan.is_pruned))) for subtree in subtrees)
+        progress_bar = self.progress_monitor(self)(total=total, desc="Nodes")
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=self.processes,
+                                 mp_context=context,
+                                 initializer=_init_process,
+                                 initargs=(self,)) as executor:
+            pending = {}
+            forked = False
+
+            def submit(node: Node) -> None:
+                nonlocal forked
+                if not forked:
+                    # The pool forks its processes at the first submit: the
+                    # writes of the main process are completed before, so
+                    # that no lock or transaction is held while forking
+                    write_behind.flush()
+                    self.database_manager.flush()
+                    forked = True
+                ancestor_paths = [ancestor.get_file().get_path() for ancestor in node.ancestors]
+                root_hash = hash(node.root.get_file()) if self.artifact_store is not None else None
+                future = executor.submit(_run_node, self._get_node_address(node), ancestor_paths, root_hash)
+                pending[future] = node
+                self.progress_monitor.emit(ProgressEvent(NODE_STARTED, node))
+
+            def submit_children(node: Node) -> None:
+                for child in node.children:
+                    if not self.plan.is_pruned(child):
+                        submit(child)
+
+            try:
+                for subtree in subtrees:
+                    if self.plan.is_pruned(subtree):
+                        continue
+                    if subtree.parent is None:
+                        self._run_with_events(subtree)
+                        progress_bar.update(1)
+                        submit_children(subtree)
+                    else:
+                        self._run_ancestors(subtree)
+                        submit(subtree)
+
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        node = pending.pop(future)
+                        path, file_hash, persistent, metrics = future.result()
+                        file = FileWrapper.from_path(path, lazy=True)
+                        file.hash = file_hash #type: ignore
+                        node.set_file(file)
+                        node.persistent = persistent
+                        node.metrics = metrics
+                        self.progress_monitor.emit(ProgressEvent(NODE_FINISHED, node, metrics))
+                        progress_bar.update(1)
+                        submit_children(node)
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+            finally:
+                progress_bar.close()
+
+    def _get_node_address(self, node: Node) -> tuple:
+        '''
+        This function returns the position of a node in the forest as the
+        index of its root followed by the index of each node of its path
+        among its siblings.
+        '''
+        address = [self.root_nodes.index(node.root)]
+        for path_node in node.path[1:]:
+            address.append(path_node.parent.children.index(path_node))
+        return tuple(address)
+
+    def _get_node(self, address: tuple) -> Node:
+        '''
+        This function returns the node at the given position, see
+        _get_node_address.
+        '''
+        node = self.root_nodes[address[0]]
+        for idx in address[1:]:
+            node = node.children[idx]
+        return node
+
     def set_workers(self, original_audio_tracks: list | None,
                           packet_loss_simulators: list,
                           plc_algorithms: list,
@@ -92,10 +353,13 @@ class DataManager(object):
     
     def initialize_tree(self) -> str:
         '''
-        This function is used to initialize the data tree.
+        This function is used to initialize the data tree. The run loaded
+        by load_workers_from_database is reused as it is.
         '''
         self._recursive_tree_init()
-        self._save_run_to_database()
+        self.path_manager.create_folders()
+        if self.run is None:
+            self._save_run_to_database()
         return self.run['_id']
 
     def _recursive_tree_init(self, parent: Node | None = None, idx: int = 0):
@@ -108,37 +372,98 @@ class DataManager(object):
                 idx:            this index is used to move forward and stop the recursion and access the appropriate element of
                                 the worker_classes list.
         '''
-        database = None
         if idx == len(self.worker_classes):
             return
-        worker_class = self.worker_classes[idx]
-        node_class = self.node_classes[idx]
-        for worker, settings in worker_class:
-            settings.set_progress_monitor(self.progress_monitor)
-            folder_name, absolute_path = self.path_manager.get_node_paths(worker, settings, parent)
-            if parent is None:
-                database = self.database_manager
-            child = node_class(worker=worker, settings=settings, parent=parent, database=database, folder_name=folder_name, absolute_path=absolute_path)
-            if parent is None:
-                self.root_nodes.append(child)
+        for worker, settings in self.worker_classes[idx]:
+            child = self._create_node(worker, settings, parent, idx)
             self._recursive_tree_init(child, idx + 1)
 
-    def _save_run_to_database(self):
+    def _create_node(self, worker, settings, parent: Node | None, idx: int) -> Node:
         '''
-        This function is used to save the run as a document in the database.
+        This function instanciates a node of the idx-th level of the tree and
+        attaches it to parent (or to the root nodes if parent is None).
         '''
-        self.run = {}
-        run_id = ''
-        self.run['workers'] = []
+        database = None
+        artifact_store = None
+        settings.set_progress_monitor(self.progress_monitor)
+        folder_name, absolute_path = self.path_manager.get_node_paths(worker, settings, parent)
+        if parent is None:
+            database = self.database_manager
+            artifact_store = self.artifact_store
+        child = self.node_classes[idx](worker=worker, settings=settings, parent=parent, database=database, folder_name=folder_name, absolute_path=absolute_path, paranoid=self.paranoid, write_behind=self.write_behind, artifact_store=artifact_store)
+        if parent is None:
+            self.root_nodes.append(child)
+        return child
+
+    def add_workers(self, original_audio_tracks: list | None = None,
+                          packet_loss_simulators: list | None = None,
+                          plc_algorithms: list | None = None,
+                          output_analysers: list | None = None) -> list:
+        '''
+        This function adds new workers to the run: only the nodes using them
+        are instanciated and the run document is updated in place, keeping
+        its id. The workers already in the run are ignored.
+        It returns the root nodes of the new subtrees, to be passed to
+        run_testbench.
+
+            Inputs:
+                original_audio_tracks, packet_loss_simulators, plc_algorithms,
+                output_analysers:   the new workers of each level, as in
+                                    set_workers. None if there are none.
+        '''
+        new_worker_classes = []
+        for idx, workers in enumerate([original_audio_tracks, packet_loss_simulators, plc_algorithms, output_analysers]):
+            existing = [(worker.__name__, settings.to_dict()) for worker, settings in self.worker_classes[idx]]
+            new_workers = [(worker, settings) for worker, settings in workers or [] if (worker.__name__, settings.to_dict()) not in existing]
+            self.worker_classes[idx].extend(new_workers)
+            new_worker_classes.append(new_workers)
+
+        subtrees = self._extend_tree(new_worker_classes)
+        self.path_manager.create_folders()
+        new_nodes = []
+        for subtree in subtrees:
+            new_nodes.extend([{"_id": node.get_id(), "type": type(node).__name__} for node in LevelOrderIter(subtree)])
+        self.run['workers'] = self._get_workers_documents()
+        self.run['nodes'].extend(new_nodes)
+        self.database_manager.update_run(self.run['_id'], self.run['workers'], new_nodes)
+        return subtrees
+
+    def _extend_tree(self, new_worker_classes: list, parent: Node | None = None, idx: int = 0) -> list:
+        '''
+        This function recursively instanciates the nodes using the new workers
+        below parent and returns the root nodes of the new subtrees.
+        '''
+        if idx == len(self.worker_classes):
+            return []
+        subtrees = []
+        for child in list(self.root_nodes if parent is None else parent.children):
+            subtrees.extend(self._extend_tree(new_worker_classes, child, idx + 1))
+        for worker, settings in new_worker_classes[idx]:
+            child = self._create_node(worker, settings, parent, idx)
+            self._recursive_tree_init(child, idx + 1)
+            subtrees.append(child)
+        return subtrees
+
+    def _get_workers_documents(self) -> list:
+        workers_documents = []
         for worker_class in self.worker_classes:
             workers = []
             for worker, settings in worker_class:
                 workers.append({"name": worker.__name__, "settings": settings.to_dict()})
-            self.run['workers'].append(workers)
+            workers_documents.append(workers)
+        return workers_documents
+
+    def _save_run_to_database(self):
+        '''
+        This function is used to save the run as a document in the database.
+        '''
+        self.run = {}
+        run_id = ''
+        self.run['workers'] = self._get_workers_documents()
 
         self.run['nodes'] = []
         for root_node in self.root_nodes:
-            self.run['nodes'].extend([{"_id": node.get_id()} for node in list(LevelOrderIter(root_node))])
+            self.run['nodes'].extend([{"_id": node.get_id(), "type": type(node).__name__} for node in list(LevelOrderIter(root_node))])
 
         for node in self.run['nodes']:
             run_id += str(node['_id'])
@@ -154,6 +479,7 @@ class DataManager(object):
         This function is used to load the workers from the database.
         '''
         run = self.database_manager.get_run(run_id)
+        self.run = run
         self.worker_classes = []
         for worker_type in run['workers'] if run is not None else []:
             workers = []
@@ -166,7 +492,16 @@ class DataManager(object):
     def _set_run_status(self, state: str):
         '''
         This function is used to set the state of the run in the database.
+        The queued writes and the buffered documents of the nodes are
+        written first: if any of them fails, the run is marked as failed.
         '''
+        try:
+            write_behind.flush()
+        except BaseException:
+            self.database_manager.flush()
+            self.database_manager.set_run_status(self.run['_id'], 'FAILED')
+            raise
+        self.database_manager.flush()
         self.database_manager.set_run_status(self.run['_id'], state)
 
     def get_nodes_by_depth(self, depth: int) -> typing.Tuple:
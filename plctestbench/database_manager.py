@@ -1,36 +1,185 @@
+import os
+import json
+import sqlite3
+import threading
 from pathlib import Path
 from abc import ABCMeta, abstractmethod
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, ReplaceOne
 from pymongo import errors
 from pymongo.errors import DuplicateKeyError
 from tinydb import TinyDB, where, operations
-from tempfile import NamedTemporaryFile
 from datetime import datetime
 from plctestbench.node import Node
 from plctestbench.utils import escape_email
 
-class Singleton (ABCMeta):
-    _instances = {}
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
-        return cls._instances[cls]
-  
-class DatabaseManager(metaclass=Singleton):
+# Maximum number of ids of a single $in query
+PREFETCH_CHUNK_SIZE = 10000
+# Maximum number of ids of a single IN clause, below the SQLite limit on the number of parameters
+SQLITE_CHUNK_SIZE = 900
+# Seconds an SQLite connection waits for the lock held by another process
+SQLITE_TIMEOUT = 60
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS collections (name TEXT PRIMARY KEY, child_collection TEXT);
+CREATE TABLE IF NOT EXISTS nodes (_id TEXT PRIMARY KEY, collection TEXT NOT NULL, parent TEXT, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent);
+CREATE TABLE IF NOT EXISTS runs (_id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS run_nodes (run_id TEXT NOT NULL, position INTEGER NOT NULL, node_id TEXT NOT NULL, type TEXT, PRIMARY KEY (run_id, position));
+CREATE INDEX IF NOT EXISTS run_nodes_node_id ON run_nodes (node_id);
+CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, doc TEXT NOT NULL);
+'''
+
+def _chunks(ids: list, chunk_size: int = PREFETCH_CHUNK_SIZE):
+    for start in range(0, len(ids), chunk_size):
+        yield ids[start:start + chunk_size]
+
+def _placeholders(values: list) -> str:
+    return ", ".join("?" * len(values))
+
+# Clients shared by all the database managers of the process, indexed by connection
+_clients = {}
+# Users already saved through each client, as (connection, email) pairs
+_saved_users = set()
+# Databases whose indexes have been created through each client, as (connection, email) pairs
+_indexed_databases = set()
+_clients_lock = threading.Lock()
+# Clients inherited by a forked process, see _reset_clients
+_inherited_clients = []
+
+def get_client(key, factory):
+    '''
+    This function returns the client registered for the given connection,
+    creating it with factory the first time, so that the database managers
+    of many testbenches (and users) share the same connection pool.
+
+        Inputs:
+            key:        a hashable description of the connection (e.g.
+                        the connection string).
+            factory:    a function without arguments returning a new client.
+    '''
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+def _reset_clients() -> None:
+    '''
+    This function discards the clients inherited by a forked process, which
+    must not use them (e.g. MongoClient is not fork-safe), so that new ones
+    are created, see DatabaseManager.reset_after_fork.
+    '''
+    global _clients_lock, _inherited_clients
+    # Keep the clients of the parent referenced: closing them would
+    # interfere with the parent process.
+    _inherited_clients = list(_clients.values())
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+def _is_user_saved(key, email) -> bool:
+    with _clients_lock:
+        return (key, email) in _saved_users
+
+def _set_user_saved(key, email, saved: bool = True) -> None:
+    with _clients_lock:
+        if saved:
+            _saved_users.add((key, email))
+        else:
+            _saved_users.discard((key, email))
+
+class SQLiteClient(object):
+    '''
+    This class opens the SQLite files of a folder, one for each database,
+    as MongoClient does with the databases of a server. SQLite connections
+    cannot be shared between threads or with forked processes, so each
+    thread of each process opens its own ones.
+
+        Inputs:
+            folder: the folder containing the database files.
+    '''
+    def __init__(self, folder) -> None:
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+    def __getitem__(self, db_name: str) -> sqlite3.Connection:
+        if self.pid != os.getpid():
+            # Keep the connections of the parent referenced: closing them
+            # would interfere with the parent process.
+            self.inherited = self.local
+            self.local = threading.local()
+            self.pid = os.getpid()
+        connections = self.local.__dict__.setdefault('connections', {})
+        if db_name not in connections:
+            connection = sqlite3.connect(self.folder / (db_name + ".sqlite3"), timeout=SQLITE_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SQLITE_SCHEMA)
+            connections[db_name] = connection
+        return connections[db_name]
+
+    def drop_database(self, db_name: str) -> None:
+        connections = self.local.__dict__.setdefault('connections', {})
+        if db_name in connections:
+            connections.pop(db_name).close()
+        for suffix in (".sqlite3", ".sqlite3-wal", ".sqlite3-shm"):
+            filepath = self.folder / (db_name + suffix)
+            if filepath.exists():
+                filepath.unlink()
+
+class DatabaseManager(metaclass=ABCMeta):
 
     def __init__(self, ip: str | None = None,
                  port: int | None = None,
                  username: str | None = None,
                  password: str | None = None,
                  user: dict | None = None,
-                 conn_string: str | None = None) -> None:
+                 conn_string: str | None = None,
+                 batch_size: int = 1000) -> None:
         
         if (ip is None or port is None or username is None or password is None or user is None) and conn_string is None:
             raise Exception("DatabaseManager: missing parameters")
         self.initialized = False
+        self.batch_size = batch_size
+        # Documents of the nodes, indexed by (collection name, node id), None if not in the database
+        self.node_cache = {}
+        # Buffered writes of the nodes, indexed by collection name
+        self.pending_writes = {}
+        # The nodes may be saved by the write-behind thread
+        self.lock = threading.RLock()
+        # Store of the files of the nodes, see ArtifactStore. None if the
+        # files are stored in the folder tree.
+        self.artifact_store = None
         self.email = escape_email(user['email']) if user is not None else None
-        self._init_client(ip, port, username, password, user)
+        self.client_arguments = (ip, port, username, password, user, conn_string)
+        self._init_client(ip, port, username, password, user, conn_string)
+
+    def reset_after_fork(self) -> None:
+        '''
+        This function is called in a forked process before using the
+        database: the writes buffered by the parent are discarded, as the
+        parent writes them, and a new client is created. The lock may have
+        been held by another thread of the parent when the process was
+        forked, so it is created again.
+        '''
+        self.lock = threading.RLock()
+        self.pending_writes = {}
+        _reset_clients()
+        self._init_client(*self.client_arguments)
+
+    def _delete_file(self, filepath) -> None:
+        '''
+        This function deletes the file of a deleted node. The files in the
+        artifact store are only dereferenced, as other databases may use
+        them: they are deleted by ArtifactStore.gc.
+        '''
+        if self.artifact_store is not None and self.artifact_store.contains(filepath):
+            self.artifact_store.remove_reference(self.artifact_store.get_key(filepath))
+            return
+        filepath = Path(filepath)
+        if filepath.exists():
+            filepath.unlink()
 
     @abstractmethod
     def _init_client(self, ip: str | None = None,
@@ -54,7 +203,23 @@ class DatabaseManager(metaclass=Singleton):
         raise NotImplementedError('To be overridden!')
 
     @abstractmethod
-    def delete_node(self, node_id):
+    def update_node(self, node_id, fields, collection_name):
+        raise NotImplementedError('To be overridden!')
+
+    @abstractmethod
+    def prefetch_nodes(self, node_ids):
+        raise NotImplementedError('To be overridden!')
+
+    @abstractmethod
+    def flush(self):
+        raise NotImplementedError('To be overridden!')
+
+    @abstractmethod
+    def delete_node(self, node_id, collection_name=None):
+        raise NotImplementedError('To be overridden!')
+
+    @abstractmethod
+    def get_worker_statistics(self):
         raise NotImplementedError('To be overridden!')
 
     @abstractmethod
@@ -69,6 +234,10 @@ class DatabaseManager(metaclass=Singleton):
     def set_run_status(self, run_id, status):
         raise NotImplementedError('To be overridden!')
 
+    @abstractmethod
+    def update_run(self, run_id, workers, new_nodes):
+        raise NotImplementedError('To be overridden!')
+
     @abstractmethod
     def delete_run(self, run_id):
         raise NotImplementedError('To be overridden!')
@@ -105,15 +274,19 @@ class MongoDatabaseManager(DatabaseManager):
         self.username = username
         self.password = password
         if conn_string:
-            self.client = MongoClient(conn_string)
+            self.client_key = ('mongodb', conn_string)
+            self.client = get_client(self.client_key, lambda: MongoClient(conn_string))
         else:
-            self.client = MongoClient(
+            self.client_key = ('mongodb', ip, port, username, password)
+            self.client = get_client(self.client_key, lambda: MongoClient(
                 host=ip,
                 port=port,
                 username=self.username,
                 password=self.password,
-            )
+            ))
+        self.child_collections = {}
         self._check_if_already_initialized()
+        self._create_indexes()
         self.save_user(user)
 
     def get_database(self):
@@ -121,53 +294,166 @@ class MongoDatabaseManager(DatabaseManager):
             raise Exception("DatabaseManager: email not set")
         return self.client[self.email]
 
-    def add_node(self, entry, collection_name):
+    def _create_indexes(self) -> None:
         '''
-        This function is used to add a node to the database.
+        This function is used to create the indexes used to find the children
+        of a node and the runs containing a node. They are created once for
+        each database of each client, as the collections created later are
+        indexed by add_node and save_run.
         '''
+        with _clients_lock:
+            if (self.client_key, self.email) in _indexed_databases:
+                return
         database = self.get_database()
-        try:
-            database[collection_name].insert_one(entry)
-        except DuplicateKeyError as e:
-            if entry['persistent']:
-                raise e
+        for collection in database.list_collection_names():
+            if collection == "runs":
+                database[collection].create_index("nodes._id")
             else:
-                database[collection_name].replace_one({"_id": entry["_id"]}, entry)
+                database[collection].create_index("parent")
+        with _clients_lock:
+            _indexed_databases.add((self.client_key, self.email))
+
+    def add_node(self, entry, collection_name):
+        '''
+        This function is used to add a node to the database. The documents
+        of the nodes are buffered and written in bulk by flush, which is
+        called as soon as batch_size documents are pending.
+        '''
+        if "_id" not in entry:
+            self.get_database()[collection_name].insert_one(entry)
+            self.get_database()[collection_name].create_index("parent")
+            return
+        if entry['persistent']:
+            operation = InsertOne(entry)
+        else:
+            operation = ReplaceOne({"_id": entry["_id"]}, entry, upsert=True)
+        with self.lock:
+            self.pending_writes.setdefault(collection_name, []).append(operation)
+            self.node_cache[(collection_name, entry["_id"])] = entry
+            if sum(len(operations) for operations in self.pending_writes.values()) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        '''
+        This function is used to write the buffered documents to the database.
+        '''
+        with self.lock:
+            pending_writes, self.pending_writes = self.pending_writes, {}
+            database = self.get_database()
+            for collection_name, operations in pending_writes.items():
+                database[collection_name].bulk_write(operations, ordered=True)
+
+    def prefetch_nodes(self, node_ids):
+        '''
+        This function is used to retrieve the documents of many nodes with
+        one query per collection, so that find_node does not need to query
+        the database for them.
+
+            Inputs:
+                node_ids:   a dictionary with the ids of the nodes to be
+                            retrieved, indexed by collection name.
+        '''
+        self.flush()
+        database = self.get_database()
+        for collection_name, ids in node_ids.items():
+            for chunk in _chunks(list(dict.fromkeys(ids))):
+                for node_id in chunk:
+                    self.node_cache[(collection_name, node_id)] = None
+                for doc in database[collection_name].find({"_id": {"$in": chunk}}):
+                    self.node_cache[(collection_name, doc["_id"])] = doc
 
     def find_node(self, node_id, collection_name):
         '''
         This function is used to find a node in the database.
         '''
+        if (collection_name, node_id) not in self.node_cache:
+            database = self.get_database()
+            self.node_cache[(collection_name, node_id)] = database[collection_name].find_one({"_id": node_id})
+        return self.node_cache[(collection_name, node_id)]
+
+    def update_node(self, node_id, fields, collection_name):
+        '''
+        This function is used to set some fields of a node in the database.
+        '''
+        self.flush()
         database = self.get_database()
-        return database[collection_name].find_one({"_id": node_id})
+        database[collection_name].update_one({"_id": node_id}, {"$set": fields})
+        if self.node_cache.get((collection_name, node_id)) is not None:
+            self.node_cache[(collection_name, node_id)].update(fields)
 
-    def delete_node(self, node_id):
+    def delete_node(self, node_id, collection_name=None):
         '''
         This function is used to propagate the deletion of a document to its
-        children.
+        children. The subtree is collected one level at a time and deleted
+        starting from the leaves, then the nodes are removed from the runs
+        with a single update.
+
+            Inputs:
+                node_id:            the id of the node (or the node itself).
+                collection_name:    the collection of the node. If None, it
+                                    is searched in every collection.
         '''
-        collection_name = self.get_collection(node_id)
+        self.flush()
         if isinstance(node_id, Node):
+            collection_name = type(node_id).__name__
             node_id = node_id.get_id()
+        if collection_name is None:
+            collection_name = self.get_collection(node_id)
+        if collection_name is None:
+            return
         database = self.get_database()
+        levels = [(collection_name, [node_id])]
         child_collection = self.get_child_collection(collection_name)
-        if child_collection is not None:
-            for child in list(database[child_collection].find({"parent": node_id})):
-                self.delete_node(child["_id"])
-        if collection_name is not None:
-            doc = database[collection_name].find_one({"_id": node_id})
-            if doc and 'filepath' in doc:
-                filepath = Path(doc['filepath'])
-                if filepath.exists():
-                    filepath.unlink()
-            database[collection_name].delete_one({"_id": node_id})
-            database['runs'].update_many({}, {"$pull": {'nodes': {"_id": node_id}}})
+        while child_collection is not None and levels[-1][1]:
+            parent_ids = levels[-1][1]
+            child_ids = []
+            for chunk in _chunks(parent_ids):
+                child_ids.extend(doc["_id"] for doc in database[child_collection].find({"parent": {"$in": chunk}}, {"_id": 1}))
+            levels.append((child_collection, child_ids))
+            child_collection = self.get_child_collection(child_collection)
+
+        deleted_ids = []
+        for collection, ids in reversed(levels):
+            for chunk in _chunks(ids):
+                for doc in database[collection].find({"_id": {"$in": chunk}, "filepath": {"$exists": True}}, {"filepath": 1}):
+                    self._delete_file(doc['filepath'])
+                database[collection].delete_many({"_id": {"$in": chunk}})
+            for deleted_id in ids:
+                self.node_cache.pop((collection, deleted_id), None)
+            deleted_ids.extend(ids)
+        for chunk in _chunks(deleted_ids):
+            database['runs'].update_many({"nodes._id": {"$in": chunk}}, {"$pull": {'nodes': {"_id": {"$in": chunk}}}})
+
+    def get_worker_statistics(self):
+        '''
+        This function is used to retrieve the total wall time, CPU time, number
+        of samples, file size and number of the nodes that recorded their
+        metrics, for each worker and packet size.
+        '''
+        self.flush()
+        database = self.get_database()
+        statistics = {}
+        pipeline = [{"$match": {"metrics.cpu_time": {"$exists": True}}},
+                    {"$group": {"_id": {"worker": "$worker", "packet_size": "$packet_size"},
+                                "wall_time": {"$sum": "$metrics.wall_time"},
+                                "cpu_time": {"$sum": "$metrics.cpu_time"},
+                                "num_samples": {"$sum": "$metrics.num_samples"},
+                                "file_size": {"$sum": "$file_size"},
+                                "count": {"$sum": 1}}}]
+        for collection in database.list_collection_names():
+            if collection == "runs":
+                continue
+            for group in database[collection].aggregate(pipeline):
+                key = (group["_id"].get("worker"), group["_id"].get("packet_size"))
+                statistics[key] = {field: group[field] for field in ("wall_time", "cpu_time", "num_samples", "file_size", "count")}
+        return statistics
 
     def save_run(self, run):
         '''
         This function is used to save a run to the database.
         '''
         database = self.get_database()
+        database["runs"].create_index("nodes._id")
         try:
             database["runs"].insert_one(run)
         except DuplicateKeyError:
@@ -187,6 +473,14 @@ class MongoDatabaseManager(DatabaseManager):
         database = self.get_database()
         database["runs"].update_one({"_id": run_id}, {"$set": {"status": status}})
 
+    def update_run(self, run_id, workers, new_nodes):
+        '''
+        This function is used to replace the workers of a run and to append
+        new nodes to it.
+        '''
+        database = self.get_database()
+        database["runs"].update_one({"_id": run_id}, {"$set": {"workers": workers}, "$push": {"nodes": {"$each": new_nodes}}})
+
     def delete_run(self, run_id):
         '''
         This function is used to delete a run from the database.
@@ -196,31 +490,36 @@ class MongoDatabaseManager(DatabaseManager):
 
     def save_user(self, user):
         '''
-        This function is used to save a user to the database.
+        This function is used to save a user to the database, if it has not
+        already been saved through the same connection.
         '''
+        if _is_user_saved(self.client_key, user["email"]):
+            return
         database = self.client["global"]
-        if database["users"].find_one({"email": user["email"]}) is None:
-            database["users"].insert_one(user)
-        else:
-            print("User already exists in the database.")
+        database["users"].update_one({"email": user["email"]}, {"$setOnInsert": user}, upsert=True)
+        _set_user_saved(self.client_key, user["email"])
 
     def delete_user(self, email):
         '''
         This function is used to delete a user from the database.
         '''
+        if self.artifact_store is not None and escape_email(email) == self.email:
+            self.artifact_store.remove_owner()
         self.client.drop_database(escape_email(email))
         database = self.client["global"]
         database["users"].delete_one({'email': email})
+        _set_user_saved(self.client_key, email, False)
 
     def get_child_collection(self, collection_name):
         '''
         This function is used to retrieve the collection of the children of a node.
         '''
-        child_collection = self.get_database()[collection_name].find_one({}, {"child_collection": 1})
-        if child_collection is not None and 'child_collection' in child_collection:
-            return child_collection["child_collection"]
-        else:
-            return None
+        if collection_name not in self.child_collections:
+            child_collection = self.get_database()[collection_name].find_one({"child_collection": {"$exists": True}}, {"child_collection": 1})
+            if child_collection is None:
+                return None
+            self.child_collections[collection_name] = child_collection["child_collection"]
+        return self.child_collections[collection_name]
     
     def get_collection(self, node_id):
         '''
@@ -248,7 +547,12 @@ class TinyDBDatabaseManager(DatabaseManager):
                  password: str | None = None,
                  user: dict | None = None,
                  conn_string: str | None = None) -> None:
-        self.client: dict[str, TinyDB] = {}
+        self.folder = Path(conn_string) #type: ignore
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.client_key = ('tinydb', str(self.folder.resolve()))
+        self.client: dict[str, TinyDB] = get_client(self.client_key, dict)
+        self._check_if_already_initialized()
+        self.save_user(user)
 
     def get_database(self, db_name: str | None = None):
         if db_name is None:
@@ -256,57 +560,111 @@ class TinyDBDatabaseManager(DatabaseManager):
         if db_name is None:
             raise ValueError("db_name darf nicht None sein!")
         if db_name not in self.client:
-            with NamedTemporaryFile(prefix=f"{db_name}_", suffix=".json", delete=False) as tmp:
-                self.client[db_name] = TinyDB(tmp.name)
+            self.client[db_name] = TinyDB(self.folder / (db_name + ".json"))
         return self.client[db_name]
 
     def add_node(self, entry, collection_name: str):
         '''
-        This function is used to add a node to the database.
+        This function is used to add a node to the database. TinyDB is not
+        thread-safe and the nodes may be saved by the write-behind thread,
+        so the nodes are accessed holding the lock.
         '''
-        database: TinyDB = self.get_database()
-        database.table(collection_name).insert(entry)
+        with self.lock:
+            database: TinyDB = self.get_database()
+            database.table(collection_name).insert(entry)
 
     def find_node(self, node_id, collection_name):
         '''
         This function is used to find a node in the database.
         '''
-        database: TinyDB = self.get_database()
-        return database.table(collection_name).get(where("_id") == node_id)
+        with self.lock:
+            database: TinyDB = self.get_database()
+            return database.table(collection_name).get(where("_id") == node_id)
+
+    def update_node(self, node_id, fields, collection_name):
+        '''
+        This function is used to set some fields of a node in the database.
+        '''
+        with self.lock:
+            database: TinyDB = self.get_database()
+            database.table(collection_name).update(fields, where("_id") == node_id)
 
-    def delete_node(self, node_id):
+    def prefetch_nodes(self, node_ids):
+        '''
+        The database is local: the nodes are not prefetched.
+        '''
+        pass
+
+    def flush(self):
+        '''
+        The documents are written immediately: there is nothing to flush.
+        '''
+        pass
+
+    def delete_node(self, node_id, collection_name=None):
         '''
         This function is used to propagate the deletion of a document to its children.
+        The subtree is collected one level at a time and deleted starting from the leaves.
         '''
-        collection_name = self.get_collection(node_id)
-        if isinstance(node_id, Node):
-            node_id = node_id.get_id()
-        database = self.get_database()
-        child_collection = self.get_child_collection(collection_name)
-        if child_collection is not None:
-            for child in list(database.table(child_collection).search(where("parent") == node_id)):
-                self.delete_node(child["_id"])
-
-        if collection_name is not None:
-            doc = database.table(collection_name).get(where("_id") == node_id)
-            if doc is not None and 'filepath' in doc:
-                if isinstance(doc, dict) and 'filepath' in doc:
-                    filepath = Path(doc['filepath'])
-                    if filepath.exists():
-                        filepath.unlink()
-
-        if collection_name is not None:
-            database.table(collection_name).remove(where("_id") == node_id)
+        with self.lock:
+            if isinstance(node_id, Node):
+                collection_name = type(node_id).__name__
+                node_id = node_id.get_id()
+            if collection_name is None:
+                collection_name = self.get_collection(node_id)
+            if collection_name is None:
+                return
+            database = self.get_database()
+            levels = [(collection_name, [node_id])]
+            child_collection = self.get_child_collection(collection_name)
+            while child_collection is not None and levels[-1][1]:
+                child_ids = [doc["_id"] for doc in database.table(child_collection).search(where("parent").one_of(levels[-1][1]))]
+                levels.append((child_collection, child_ids))
+                child_collection = self.get_child_collection(child_collection)
+
+            deleted_ids = set()
+            for collection, ids in reversed(levels):
+                for doc in database.table(collection).search(where("_id").one_of(ids)):
+                    if 'filepath' in doc:
+                        self._delete_file(doc['filepath'])
+                database.table(collection).remove(where("_id").one_of(ids))
+                deleted_ids.update(ids)
             for doc in database.table("runs").all():
-                updated_nodes = [node for node in doc['nodes'] if node['_id'] != node_id]
-                database.table(collection_name).update({'nodes': updated_nodes}, where("_id") == node_id)
+                updated_nodes = [node for node in doc['nodes'] if node['_id'] not in deleted_ids]
+                if len(updated_nodes) != len(doc['nodes']):
+                    database.table("runs").update({'nodes': updated_nodes}, where("_id") == doc["_id"])
+
+    def get_worker_statistics(self):
+        '''
+        This function is used to retrieve the total wall time, CPU time, number
+        of samples, file size and number of the nodes that recorded their
+        metrics, for each worker and packet size.
+        '''
+        statistics = {}
+        for collection in self.get_database().tables():
+            if collection == "runs":
+                continue
+            for doc in self.get_database().table(collection).all():
+                if "metrics" not in doc:
+                    continue
+                group = statistics.setdefault((doc.get("worker"), doc.get("packet_size")), {"wall_time": 0., "cpu_time": 0., "num_samples": 0, "file_size": 0, "count": 0})
+                group["wall_time"] += doc["metrics"]["wall_time"]
+                group["cpu_time"] += doc["metrics"]["cpu_time"]
+                group["num_samples"] += doc["metrics"]["num_samples"]
+                group["file_size"] += doc.get("file_size", 0)
+                group["count"] += 1
+        return statistics
 
     def save_run(self, run):
         '''
         This function is used to save a run to the database.
         '''
         database = self.get_database()
-        database.table("runs").insert(self._serialize_run(run))
+        with self.lock:
+            if database.table("runs").contains(where("_id") == run["_id"]):
+                print("Run already exists in the database.")
+                return
+            database.table("runs").insert(self._serialize_run(run))
 
     def get_run(self, run_id):
         '''
@@ -322,6 +680,16 @@ class TinyDBDatabaseManager(DatabaseManager):
         database = self.get_database()
         database.table("runs").update(operations.set("status", status), where("_id") == run_id)
 
+    def update_run(self, run_id, workers, new_nodes):
+        '''
+        This function is used to replace the workers of a run and to append
+        new nodes to it.
+        '''
+        database = self.get_database()
+        run = database.table("runs").get(where("_id") == run_id)
+        if run is not None:
+            database.table("runs").update({"workers": workers, "nodes": run["nodes"] + new_nodes}, where("_id") == run_id)
+
     def delete_run(self, run_id):
         '''
         This function is used to delete a run from the database.
@@ -333,19 +701,29 @@ class TinyDBDatabaseManager(DatabaseManager):
         '''
         This function is used to save a user to the database.
         '''
+        if _is_user_saved(self.client_key, user["email"]):
+            return
         database = self.get_database("global")
-        if database.table("users").search(where("email") == user["email"]) is None:
+        if not database.table("users").contains(where("email") == user["email"]):
             database.table("users").insert(user)
-        else:
-            print("User already exists in the database.")
+        _set_user_saved(self.client_key, user["email"])
 
     def delete_user(self, email):
         '''
         This function is used to delete a user from the database.
         '''
-        self.client.drop_database(escape_email(email)) # type: ignore
+        if self.artifact_store is not None and escape_email(email) == self.email:
+            self.artifact_store.remove_owner()
+        db_name = escape_email(email)
+        with self.lock:
+            if db_name in self.client:
+                self.client.pop(db_name).close()
+            filepath = self.folder / (db_name + ".json")
+            if filepath.exists():
+                filepath.unlink()
         database = self.get_database("global")
         database.table("users").remove(where("email") == email)
+        _set_user_saved(self.client_key, email, False)
 
     def get_child_collection(self, collection_name):
         '''
@@ -363,7 +741,7 @@ class TinyDBDatabaseManager(DatabaseManager):
         This function is used to retrieve the collection of a node.
         '''
         for collection in self.get_database().tables():
-            if self.get_database().table(collection).contains(doc_id=node_id) is not None:
+            if self.get_database().table(collection).contains(where("_id") == node_id):
                 return collection
         return None
         
@@ -374,7 +752,7 @@ class TinyDBDatabaseManager(DatabaseManager):
         '''
         self.initialized = False
         for collection in self.get_database().tables():
-            if [doc["child_collection"] for doc in self.get_database().table(collection).all()] != []:
+            if self.get_database().table(collection).contains(where("child_collection").exists()):
                 self.initialized |= True
     
     def _serialize_run(self, run):
@@ -384,3 +762,277 @@ class TinyDBDatabaseManager(DatabaseManager):
     def _deserialize_run(self, run):
         run["created_on"] = datetime.fromisoformat(run["created_on"])
         return run
+
+class SQLiteDatabaseManager(DatabaseManager):
+    '''
+    This class stores the documents in SQLite files, one for each database
+    of the MongoDB implementation (the "global" one with the users and one
+    for each user), inside the folder given as conn_string. The files are
+    opened in WAL mode, so that the worker processes can read while another
+    process writes, and the buffered documents are written in a single
+    transaction.
+    '''
+
+    def _init_client(self, ip: str | None = None,
+                     port: int | None = None,
+                     username: str | None = None,
+                     password: str | None = None,
+                     user: dict | None = None,
+                     conn_string: str | None = None) -> None:
+        self.client_key = ('sqlite', str(Path(conn_string).resolve())) #type: ignore
+        self.client = get_client(self.client_key, lambda: SQLiteClient(conn_string))
+        self.child_collections = {}
+        self._check_if_already_initialized()
+        self.save_user(user)
+
+    def get_database(self, db_name: str | None = None) -> sqlite3.Connection:
+        if db_name is None:
+            db_name = self.email
+        if db_name is None:
+            raise Exception("DatabaseManager: email not set")
+        return self.client[db_name]
+
+    def add_node(self, entry, collection_name):
+        '''
+        This function is used to add a node to the database. The documents
+        of the nodes are buffered and written in a single transaction by
+        flush, which is called as soon as batch_size documents are pending.
+        '''
+        if "_id" not in entry:
+            database = self.get_database()
+            with database:
+                database.execute("INSERT OR REPLACE INTO collections (name, child_collection) VALUES (?, ?)", (collection_name, entry.get("child_collection")))
+            return
+        with self.lock:
+            self.pending_writes.setdefault(collection_name, []).append(entry)
+            self.node_cache[(collection_name, entry["_id"])] = entry
+            if sum(len(entries) for entries in self.pending_writes.values()) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        '''
+        This function is used to write the buffered documents to the database.
+        A persistent node already in the database raises an IntegrityError.
+        '''
+        with self.lock:
+            pending_writes, self.pending_writes = self.pending_writes, {}
+            if not pending_writes:
+                return
+            database = self.get_database()
+            with database:
+                for collection_name, entries in pending_writes.items():
+                    for entry in entries:
+                        statement = "INSERT" if entry['persistent'] else "INSERT OR REPLACE"
+                        database.execute(statement + " INTO nodes (_id, collection, parent, doc) VALUES (?, ?, ?, ?)",
+                                         (entry["_id"], collection_name, entry.get("parent"), json.dumps(entry)))
+
+    def prefetch_nodes(self, node_ids):
+        '''
+        This function is used to retrieve the documents of many nodes with
+        a few queries per collection, so that find_node does not need to
+        query the database for them.
+
+            Inputs:
+                node_ids:   a dictionary with the ids of the nodes to be
+                            retrieved, indexed by collection name.
+        '''
+        self.flush()
+        database = self.get_database()
+        for collection_name, ids in node_ids.items():
+            for chunk in _chunks(list(dict.fromkeys(ids)), SQLITE_CHUNK_SIZE):
+                for node_id in chunk:
+                    self.node_cache[(collection_name, node_id)] = None
+                rows = database.execute("SELECT doc FROM nodes WHERE collection = ? AND _id IN (" + _placeholders(chunk) + ")", [collection_name] + chunk)
+                for (doc,) in rows:
+                    doc = json.loads(doc)
+                    self.node_cache[(collection_name, doc["_id"])] = doc
+
+    def find_node(self, node_id, collection_name):
+        '''
+        This function is used to find a node in the database.
+        '''
+        if (collection_name, node_id) not in self.node_cache:
+            row = self.get_database().execute("SELECT doc FROM nodes WHERE collection = ? AND _id = ?", (collection_name, node_id)).fetchone()
+            self.node_cache[(collection_name, node_id)] = json.loads(row[0]) if row is not None else None
+        return self.node_cache[(collection_name, node_id)]
+
+    def update_node(self, node_id, fields, collection_name):
+        '''
+        This function is used to set some fields of a node in the database.
+        '''
+        self.flush()
+        database = self.get_database()
+        with database:
+            row = database.execute("SELECT doc FROM nodes WHERE collection = ? AND _id = ?", (collection_name, node_id)).fetchone()
+            if row is None:
+                return
+            doc = json.loads(row[0])
+            doc.update(fields)
+            database.execute("UPDATE nodes SET doc = ? WHERE _id = ?", (json.dumps(doc), node_id))
+        if self.node_cache.get((collection_name, node_id)) is not None:
+            self.node_cache[(collection_name, node_id)].update(fields)
+
+    def delete_node(self, node_id, collection_name=None):
+        '''
+        This function is used to propagate the deletion of a document to its
+        children. The subtree is collected one level at a time and deleted
+        starting from the leaves, in a single transaction.
+
+            Inputs:
+                node_id:            the id of the node (or the node itself).
+                collection_name:    the collection of the node. If None, it
+                                    is retrieved from the database.
+        '''
+        self.flush()
+        if isinstance(node_id, Node):
+            collection_name = type(node_id).__name__
+            node_id = node_id.get_id()
+        if collection_name is None:
+            collection_name = self.get_collection(node_id)
+        if collection_name is None:
+            return
+        database = self.get_database()
+        levels = [(collection_name, [node_id])]
+        child_collection = self.get_child_collection(collection_name)
+        while child_collection is not None and levels[-1][1]:
+            child_ids = []
+            for chunk in _chunks(levels[-1][1], SQLITE_CHUNK_SIZE):
+                rows = database.execute("SELECT _id FROM nodes WHERE collection = ? AND parent IN (" + _placeholders(chunk) + ")", [child_collection] + chunk)
+                child_ids.extend(row[0] for row in rows)
+            levels.append((child_collection, child_ids))
+            child_collection = self.get_child_collection(child_collection)
+
+        with database:
+            for collection, ids in reversed(levels):
+                for chunk in _chunks(ids, SQLITE_CHUNK_SIZE):
+                    for (doc,) in database.execute("SELECT doc FROM nodes WHERE _id IN (" + _placeholders(chunk) + ")", chunk).fetchall():
+                        doc = json.loads(doc)
+                        if 'filepath' in doc:
+                            self._delete_file(doc['filepath'])
+                    database.execute("DELETE FROM nodes WHERE _id IN (" + _placeholders(chunk) + ")", chunk)
+                    database.execute("DELETE FROM run_nodes WHERE node_id IN (" + _placeholders(chunk) + ")", chunk)
+                for deleted_id in ids:
+                    self.node_cache.pop((collection, deleted_id), None)
+
+    def get_worker_statistics(self):
+        '''
+        This function is used to retrieve the total wall time, CPU time, number
+        of samples, file size and number of the nodes that recorded their
+        metrics, for each worker and packet size.
+        '''
+        self.flush()
+        rows = self.get_database().execute("SELECT json_extract(doc, '$.worker'), json_extract(doc, '$.packet_size'), "
+                                           "SUM(json_extract(doc, '$.metrics.wall_time')), SUM(json_extract(doc, '$.metrics.cpu_time')), SUM(json_extract(doc, '$.metrics.num_samples')), "
+                                           "SUM(json_extract(doc, '$.file_size')), COUNT(*) "
+                                           "FROM nodes WHERE json_extract(doc, '$.metrics.cpu_time') IS NOT NULL GROUP BY 1, 2")
+        return {(worker, packet_size): {"wall_time": wall_time, "cpu_time": cpu_time, "num_samples": num_samples, "file_size": file_size or 0, "count": count}
+                for worker, packet_size, wall_time, cpu_time, num_samples, file_size, count in rows}
+
+    def save_run(self, run):
+        '''
+        This function is used to save a run to the database. The nodes of
+        the run are stored in their own table, indexed by node id.
+        '''
+        database = self.get_database()
+        doc = {key: value for key, value in run.items() if key != 'nodes'}
+        doc['created_on'] = doc['created_on'].isoformat()
+        try:
+            with database:
+                database.execute("INSERT INTO runs (_id, doc) VALUES (?, ?)", (run['_id'], json.dumps(doc)))
+                database.executemany("INSERT INTO run_nodes (run_id, position, node_id, type) VALUES (?, ?, ?, ?)",
+                                     [(run['_id'], position, node['_id'], node.get('type')) for position, node in enumerate(run['nodes'])])
+        except sqlite3.IntegrityError:
+            print("Run already exists in the database.")
+
+    def get_run(self, run_id):
+        '''
+        This function is used to retrieve a run from the database.
+        '''
+        database = self.get_database()
+        row = database.execute("SELECT doc FROM runs WHERE _id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        run = json.loads(row[0])
+        run['created_on'] = datetime.fromisoformat(run['created_on'])
+        run['nodes'] = []
+        for node_id, node_type in database.execute("SELECT node_id, type FROM run_nodes WHERE run_id = ? ORDER BY position", (run_id,)):
+            run['nodes'].append({"_id": node_id, "type": node_type} if node_type is not None else {"_id": node_id})
+        return run
+
+    def set_run_status(self, run_id, status):
+        '''
+        This function is used to set the status of a run in the database.
+        '''
+        database = self.get_database()
+        with database:
+            database.execute("UPDATE runs SET doc = json_set(doc, '$.status', ?) WHERE _id = ?", (status, run_id))
+
+    def update_run(self, run_id, workers, new_nodes):
+        '''
+        This function is used to replace the workers of a run and to append
+        new nodes to it.
+        '''
+        database = self.get_database()
+        with database:
+            database.execute("UPDATE runs SET doc = json_set(doc, '$.workers', json(?)) WHERE _id = ?", (json.dumps(workers), run_id))
+            start = database.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM run_nodes WHERE run_id = ?", (run_id,)).fetchone()[0]
+            database.executemany("INSERT INTO run_nodes (run_id, position, node_id, type) VALUES (?, ?, ?, ?)",
+                                 [(run_id, start + position, node['_id'], node.get('type')) for position, node in enumerate(new_nodes)])
+
+    def delete_run(self, run_id):
+        '''
+        This function is used to delete a run from the database.
+        '''
+        database = self.get_database()
+        with database:
+            database.execute("DELETE FROM run_nodes WHERE run_id = ?", (run_id,))
+            database.execute("DELETE FROM runs WHERE _id = ?", (run_id,))
+
+    def save_user(self, user):
+        '''
+        This function is used to save a user to the database, if it has not
+        already been saved through the same connection.
+        '''
+        if _is_user_saved(self.client_key, user["email"]):
+            return
+        database = self.get_database("global")
+        with database:
+            database.execute("INSERT OR IGNORE INTO users (email, doc) VALUES (?, ?)", (user["email"], json.dumps(user)))
+        _set_user_saved(self.client_key, user["email"])
+
+    def delete_user(self, email):
+        '''
+        This function is used to delete a user from the database.
+        '''
+        if self.artifact_store is not None and escape_email(email) == self.email:
+            self.artifact_store.remove_owner()
+        self.client.drop_database(escape_email(email))
+        database = self.get_database("global")
+        with database:
+            database.execute("DELETE FROM users WHERE email = ?", (email,))
+        _set_user_saved(self.client_key, email, False)
+
+    def get_child_collection(self, collection_name):
+        '''
+        This function is used to retrieve the collection of the children of a node.
+        '''
+        if collection_name not in self.child_collections:
+            row = self.get_database().execute("SELECT child_collection FROM collections WHERE name = ?", (collection_name,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            self.child_collections[collection_name] = row[0]
+        return self.child_collections[collection_name]
+
+    def get_collection(self, node_id):
+        '''
+        This function is used to retrieve the collection of a node.
+        '''
+        row = self.get_database().execute("SELECT collection FROM nodes WHERE _id = ?", (node_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _check_if_already_initialized(self) -> None:
+        '''
+        This function is used to check if the database has already been initialized.
+        '''
+        row = self.get_database().execute("SELECT COUNT(*) FROM collections").fetchone()
+        self.initialized = row[0] > 0
@@ -1,14 +1,26 @@
 from __future__ import annotations
+import io
 import os
 import pickle
+import time
+from math import ceil
 from pathlib import Path
 from numpy import ndarray
 import soundfile as sf
 import numpy as np
 from plctestbench.utils import compute_hash
+from plctestbench.hashing import hash_buffer, hash_file
+from plctestbench import write_behind
 
 DEFAULT_DTYPE = 'float32'
 
+# Subtypes that store DEFAULT_DTYPE samples without loss of precision
+LOSSLESS_SUBTYPES = ('FLOAT', 'DOUBLE')
+
+def _write_bytes(path, content: bytes) -> None:
+    with open(path, 'wb') as file:
+        file.write(content)
+
 def calculate_hash(*args) -> int:
     data = ''
     for arg in args:
@@ -19,35 +31,56 @@ def calculate_hash(*args) -> int:
 class FileWrapper(object):
     def __init__(self, data = None,
                  path: str | None = None,
-                 persist = True) -> None:
+                 persist = True,
+                 lazy = False,
+                 background = False) -> None:
+        '''
+        When lazy is True and no data is given, the file is not read until
+        its data is requested with get_data.
+        When background is True the data is written to disk by the
+        write-behind queue: call wait before reading the file from disk.
+        '''
         self.data = np.ascontiguousarray(data.astype(DEFAULT_DTYPE)) if isinstance(data, np.ndarray) else data
         self.path = path
         self.persist = persist
+        self.lazy = lazy
+        self.background = background
+        self._pending_write = None
+        # The hash is the hash of the content of the file: it is computed by
+        # save from the encoded data, or from the file when first needed.
+        self.hash = None
+        # Time spent computing the hash, in seconds
+        self.hash_time = 0.
 
         if self.path is None:
             raise ValueError('path must be specified')
 
+        # The data passed to the constructor is kept in memory: the file
+        # is read back only when the wrapper is created from a path.
         if self.data is not None:
             self.save()
-
-        self.load()
-
-        self.hash = calculate_hash(self.data.tobytes()) if isinstance(self.data, ndarray) else hash(self.data)
+        else:
+            self.load()
 
     @classmethod
-    def from_path(cls, path: str) -> FileWrapper | None:
+    def from_path(cls, path: str, lazy: bool = False) -> FileWrapper | None:
         if not Path(path).exists():
             return None
 
         if path.split('.')[-1] == 'wav':
-            file = AudioFile(path=path)
+            file = AudioFile(path=path, lazy=lazy)
         else:
-            file = DataFile(path=path)
+            file = DataFile(path=path, lazy=lazy)
         return file
 
     def get_data(self) -> ndarray | None:
+        if self.data is None and self.lazy:
+            self.data = self._read_data()
         return self.data
 
+    def _read_data(self):
+        return None
+
     def get_path(self) -> str | None:
         return self.path
 
@@ -60,13 +93,56 @@ class FileWrapper(object):
     def load(self) -> ndarray | None:
         pass
 
+    def _write(self, content) -> None:
+        if self.background:
+            self._pending_write = write_behind.submit(_write_bytes, self.path, bytes(content))
+        else:
+            _write_bytes(self.path, content)
+
+    def wait(self) -> None:
+        '''
+        This function waits for the background write of the file, if any.
+        '''
+        if self._pending_write is not None:
+            pending_write, self._pending_write = self._pending_write, None
+            pending_write.result()
+
     def delete(self) -> None:
+        self.wait()
         if self.path is not None:
             os.remove(self.path)
 
+    def get_stat(self) -> dict:
+        '''
+        This function returns the size, the modification time and the inode
+        of the file, which are stored in the database to detect changes to
+        the file without hashing it.
+        '''
+        self.wait()
+        stat = os.stat(self.path) #type: ignore
+        # The inode is stored as a string as it may not fit in a 64 bit signed integer
+        return {"file_size": stat.st_size, "file_mtime_ns": stat.st_mtime_ns, "file_inode": str(stat.st_ino)}
+
+    def get_legacy_hash(self) -> int:
+        '''
+        This function returns the hash of the data computed as in the
+        databases without a hash_version, see hashing.HASH_VERSION.
+        '''
+        data = self.get_data()
+        return calculate_hash(data.tobytes()) if isinstance(data, ndarray) else hash(data)
+
     def __hash__(self):
+        if self.hash is None:
+            self.wait()
+            start_time = time.perf_counter()
+            self.hash = hash_file(self.path)
+            self.hash_time += time.perf_counter() - start_time
         return self.hash
 
+    def __getstate__(self) -> dict:
+        self.wait()
+        return self.__dict__.copy()
+
 class AudioFile(FileWrapper):
     def __init__(self, data: ndarray|None=None,
                        path: str|None=None,
@@ -75,14 +151,22 @@ class AudioFile(FileWrapper):
                        subtype: str|None=None,
                        endian: str|None=None,
                        audio_format: str|None=None,
-                       persist=True) -> None:
-
+                       persist=True,
+                       lazy=False,
+                       background=False) -> None:
+        '''
+        When lazy is True the file is not opened until its metadata or its
+        samples are requested: the samples are read the first time get_data
+        or read is called. Files with float samples are memory-mapped, the
+        others are decoded.
+        '''
         self.samplerate = samplerate
         self.channels = channels
         self.subtype = subtype
         self.endian = endian
         self.audio_format = audio_format
-        super().__init__(data, path, persist)
+        self.frames = None
+        super().__init__(data, path, persist, lazy, background)
 
     @classmethod
     def from_audio_file(cls, audio_file: AudioFile,
@@ -92,75 +176,280 @@ class AudioFile(FileWrapper):
                              new_channels: int|None=None,
                              new_subtype: str|None=None,
                              new_endian: str|None=None,
-                             new_audio_format: str|None=None) -> AudioFile:
-        data = audio_file.data if new_data is None else new_data
-        path = audio_file.path if new_path is None else new_path
-        samplerate = audio_file.samplerate if new_samplerate is None else new_samplerate
-        channels = audio_file.channels if new_channels is None else new_channels
-        subtype = audio_file.subtype if new_subtype is None else new_subtype
-        endian = audio_file.endian if new_endian is None else new_endian
-        audio_format = audio_file.audio_format if new_audio_format is None else new_audio_format
+                             new_audio_format: str|None=None,
+                             background: bool=False) -> AudioFile:
+        data = audio_file.get_data() if new_data is None else new_data
+        path = audio_file.get_path() if new_path is None else new_path
+        samplerate = audio_file.get_samplerate() if new_samplerate is None else new_samplerate
+        channels = audio_file.get_channels() if new_channels is None else new_channels
+        subtype = audio_file.get_subtype() if new_subtype is None else new_subtype
+        endian = audio_file.get_endian() if new_endian is None else new_endian
+        audio_format = audio_file.get_audio_format() if new_audio_format is None else new_audio_format
         new_instance = cls(data,
                            path,
                            samplerate,
                            channels,
                            subtype,
                            endian,
-                           audio_format)
+                           audio_format,
+                           background=background)
         return new_instance
 
     def get_samplerate(self) -> float | None:
+        self._read_header()
         return self.samplerate
 
     def get_channels(self) -> int | None:
+        self._read_header()
         return self.channels
 
     def get_subtype(self) -> str | None:
+        self._read_header()
         return self.subtype
 
     def get_endian(self) -> str | None:
+        self._read_header()
         return self.endian
 
     def get_audio_format(self) -> str | None:
+        self._read_header()
         return self.audio_format
 
+    def get_frames(self) -> int | None:
+        self._read_header()
+        return self.frames
+
+    def _read_data(self) -> ndarray:
+        self._read_header()
+        return self._map() if self._is_mappable() else self._decode()
+
+    def read(self, start: int = 0, stop: int | None = None) -> ndarray:
+        '''
+        This function returns the frames from start to stop without reading
+        the rest of the file if the data has not been loaded yet.
+        '''
+        self._read_header()
+        if self.data is not None or self._is_mappable():
+            return self.get_data()[start:stop] #type: ignore
+        return self._decode(start, stop)
+
     def save(self) -> None:
-        sf.write(self.path,
+        '''
+        This function encodes the data in memory and writes it to disk. The
+        metadata is taken from the encoded file and, if the subtype quantizes
+        the samples, the data is replaced by its decoded version, so that it
+        is the same that would be read back from disk.
+        '''
+        self.wait()
+        audio_format = self.audio_format if self.audio_format is not None else Path(self.path).suffix[1:].upper() #type: ignore
+        buffer = io.BytesIO()
+        sf.write(buffer,
                  self.data,
                  self.samplerate,
                  self.subtype,
                  self.endian,
-                 self.audio_format)
-
-    def load(self) -> ndarray:
-        with sf.SoundFile(self.path, 'r') as file:
-            self.data = file.read(dtype=DEFAULT_DTYPE)
-            self.path = file.name
-            self.samplerate = file.samplerate
-            self.channels = file.channels
-            self.subtype = file.subtype
-            self.endian = file.endian
-            self.audio_format = file.format
+                 audio_format)
+        buffer.seek(0)
+        with sf.SoundFile(buffer, 'r') as file:
+            if file.subtype not in LOSSLESS_SUBTYPES:
+                self.data = file.read(dtype=DEFAULT_DTYPE)
+            elif file.channels == 1:
+                self.data = np.reshape(self.data, -1) #type: ignore
+            self._set_header(file)
+
+        content = buffer.getbuffer()
+        start_time = time.perf_counter()
+        self.hash = hash_buffer(content)
+        self.hash_time += time.perf_counter() - start_time
+        self._write(content)
+
+    def load(self) -> ndarray | None:
+        if not self.lazy:
+            with sf.SoundFile(self.path, 'r') as file:
+                self._set_header(file)
+                self.data = file.read(dtype=DEFAULT_DTYPE)
 
         return self.data
 
+    def _read_header(self) -> None:
+        if self.frames is None:
+            with sf.SoundFile(self.path, 'r') as file:
+                self._set_header(file)
+
+    def _set_header(self, file: sf.SoundFile) -> None:
+        self.samplerate = file.samplerate
+        self.channels = file.channels
+        self.subtype = file.subtype
+        self.endian = file.endian
+        self.audio_format = file.format
+        self.frames = file.frames
+
+    def _decode(self, start: int = 0, stop: int | None = None) -> ndarray:
+        data, _ = sf.read(self.path, start=start, stop=stop, dtype=DEFAULT_DTYPE)
+        return data
+
+    def _is_mappable(self) -> bool:
+        '''
+        The samples can be mapped directly only if they are stored in the
+        file as little-endian 32 bit floats, i.e. as DEFAULT_DTYPE.
+        '''
+        return self.audio_format == 'WAV' and self.subtype == 'FLOAT' and self.endian in ('FILE', 'LITTLE')
+
+    def _map(self) -> ndarray:
+        '''
+        This function memory-maps the data chunk of the file. The map is
+        copy-on-write, so the data can be modified without touching the file.
+        '''
+        offset, size = _find_wav_data_chunk(self.path)
+        frames = min(self.frames, size // (np.dtype(DEFAULT_DTYPE).itemsize * self.channels)) #type: ignore
+        shape = (frames, self.channels) if self.channels > 1 else (frames,) #type: ignore
+        return np.memmap(self.path, dtype='<f4', mode='c', offset=offset, shape=shape)
+
+def _find_wav_data_chunk(path) -> tuple:
+    '''
+    This function returns the offset and the size in bytes of the data
+    chunk of a WAV file.
+    '''
+    with open(path, 'rb') as file:
+        header = file.read(12)
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError(f"{path} is not a RIFF WAVE file.")
+        while True:
+            chunk_header = file.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f"{path} has no data chunk.")
+            chunk_id, chunk_size = chunk_header[:4], int.from_bytes(chunk_header[4:], 'little')
+            if chunk_id == b'data':
+                return file.tell(), chunk_size
+            file.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
 
 class DataFile(FileWrapper):
-    def __init__(self, data=None, path: str|None=None, persist=True) -> None:
-        super().__init__(data, path, persist)
+    def __init__(self, data=None, path: str|None=None, persist=True, lazy=False, background=False) -> None:
+        super().__init__(data, path, persist, lazy, background)
 
     def save(self) -> None:
         if self.path is not None:
-            with open(self.path, 'wb') as file:
-                pickle.dump(self.data, file)
+            content = pickle.dumps(self.data)
+            start_time = time.perf_counter()
+            self.hash = hash_buffer(content)
+            self.hash_time += time.perf_counter() - start_time
+            self._write(content)
 
     def load(self) -> None:
+        if not self.lazy:
+            self.data = self._read_data()
+
+    def _read_data(self):
         if self.path is not None:
             with open(self.path, 'rb') as file:
                 try:
-                    self.data = pickle.load(file)
+                    return pickle.load(file)
                 except pickle.UnpicklingError:
-                    self.data = None
+                    return None
+
+
+class LostSamplesMask(object):
+    '''
+    This class stores the lost samples of a track as a list of bursts of
+    consecutive lost packets, each one identified by the index of its first
+    packet and by its length in packets.
+
+        Variables:
+            burst_starts:   index of the first packet of each burst.
+            burst_lengths:  number of consecutive lost packets of each burst.
+            packet_size:    size of each packet in samples.
+            num_samples:    length of the track in samples.
+    '''
+    def __init__(self, burst_starts, burst_lengths, packet_size: int, num_samples: int) -> None:
+        self._burst_starts = np.ascontiguousarray(burst_starts, dtype=np.int64)
+        self._burst_lengths = np.ascontiguousarray(burst_lengths, dtype=np.int64)
+        self._packet_size = int(packet_size)
+        self._num_samples = int(num_samples)
+
+    @classmethod
+    def from_lost_packets_idx(cls, lost_packets_idx, packet_size: int, num_samples: int) -> LostSamplesMask:
+        '''
+        This function builds the mask from the indexes of the lost packets.
+        '''
+        lost_packets_idx = np.unique(np.asarray(lost_packets_idx, dtype=np.int64))
+        if len(lost_packets_idx) == 0:
+            return cls([], [], packet_size, num_samples)
+        breaks = np.flatnonzero(np.diff(lost_packets_idx) != 1) + 1
+        burst_starts = lost_packets_idx[np.r_[0, breaks]]
+        burst_ends = lost_packets_idx[np.r_[breaks - 1, len(lost_packets_idx) - 1]]
+        return cls(burst_starts, burst_ends - burst_starts + 1, packet_size, num_samples)
+
+    @classmethod
+    def from_lost_samples_idx(cls, lost_samples_idx, packet_size: int, num_samples: int | None = None) -> LostSamplesMask:
+        '''
+        This function converts the legacy format (one index per lost sample)
+        to a mask. If the length of the track is unknown, the mask ends with
+        the last lost sample.
+        '''
+        lost_samples_idx = np.asarray(lost_samples_idx, dtype=np.int64)
+        if num_samples is None:
+            num_samples = int(lost_samples_idx[-1]) + 1 if len(lost_samples_idx) > 0 else 0
+        return cls.from_lost_packets_idx(lost_samples_idx // packet_size, packet_size, num_samples)
+
+    @classmethod
+    def from_data(cls, data, packet_size: int, num_samples: int | None = None) -> LostSamplesMask:
+        '''
+        This function returns the data of a lost samples mask node as a
+        LostSamplesMask, converting it if it is stored in the legacy format.
+        '''
+        if isinstance(data, LostSamplesMask):
+            return data
+        return cls.from_lost_samples_idx(data, packet_size, num_samples)
+
+    def get_packet_size(self) -> int:
+        return self._packet_size
+
+    def get_num_samples(self) -> int:
+        return self._num_samples
+
+    def get_num_packets(self) -> int:
+        return ceil(self._num_samples / self._packet_size)
+
+    def get_num_lost_packets(self) -> int:
+        return int(self._burst_lengths.sum())
+
+    def get_num_lost_samples(self) -> int:
+        return len(self.get_lost_samples_idx())
+
+    def bursts(self):
+        '''
+        This function iterates over the bursts of lost packets, yielding the
+        index of the first packet and the number of packets of each burst.
+        '''
+        for start, length in zip(self._burst_starts.tolist(), self._burst_lengths.tolist()):
+            yield start, length
+
+    def sample_bursts(self):
+        '''
+        This function iterates over the bursts of lost packets, yielding the
+        index of the first lost sample and the index following the last one.
+        '''
+        for start, length in self.bursts():
+            yield start * self._packet_size, min((start + length) * self._packet_size, self._num_samples)
+
+    def get_lost_packets_idx(self) -> ndarray:
+        '''
+        This function returns the sorted indexes of the lost packets.
+        '''
+        offsets = np.cumsum(self._burst_lengths) - self._burst_lengths
+        return np.repeat(self._burst_starts - offsets, self._burst_lengths) + np.arange(self.get_num_lost_packets())
+
+    def get_lost_samples_idx(self) -> ndarray:
+        '''
+        This function returns the indexes of the lost samples (legacy format).
+        '''
+        lost_packets_idx = self.get_lost_packets_idx()
+        lost_samples_idx = (lost_packets_idx[:, np.newaxis] * self._packet_size + np.arange(self._packet_size)).ravel()
+        return lost_samples_idx[lost_samples_idx < self._num_samples]
+
+    def __hash__(self) -> int:
+        return calculate_hash(self._burst_starts.tobytes(), self._burst_lengths.tobytes(), self._packet_size, self._num_samples)
 
 
 class OutputAnalysis():
@@ -0,0 +1,42 @@
+import hashlib
+
+# Version of the algorithm used to compute the file hashes stored in the
+# database. The documents without a version store the hash computed by
+# calculate_hash on the decoded data, see FileWrapper.get_legacy_hash.
+HASH_VERSION = 2
+
+CHUNK_SIZE = 1 << 20
+DIGEST_SIZE = 7
+
+def _new_hasher():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+def _to_int(hasher) -> int:
+    return int.from_bytes(hasher.digest(), 'little')
+
+def hash_buffer(buffer) -> int:
+    '''
+    This function returns the hash of the content of a bytes-like object
+    (e.g. the encoded content of a file).
+    '''
+    hasher = _new_hasher()
+    view = memoryview(buffer).cast('B')
+    for start in range(0, len(view), CHUNK_SIZE):
+        hasher.update(view[start:start + CHUNK_SIZE])
+    return _to_int(hasher)
+
+def hash_file(path) -> int:
+    '''
+    This function returns the hash of the content of a file, reading it one
+    chunk at a time. It is equal to the hash_buffer of the same content.
+    '''
+    hasher = _new_hasher()
+    chunk = bytearray(CHUNK_SIZE)
+    view = memoryview(chunk)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            size = file.readinto(chunk)
+            if not size:
+                break
+            hasher.update(view[:size])
+    return _to_int(hasher)
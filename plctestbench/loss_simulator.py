@@ -1,8 +1,13 @@
+from math import ceil
 import numpy as np
 import numpy.random as npr
 from plctestbench.worker import Worker
+from .file_wrapper import LostSamplesMask
 from .settings import Settings, BinomialPLSSettings, GilbertElliotPLSSettings, MetronomePLSSettings
 
+# Number of packets drawn at once by PacketLossSimulator.run
+CHUNK_SIZE = 2**16
+
 class PacketLossSimulator(Worker):
     '''
     Base class for all the loss models.
@@ -15,24 +20,33 @@ class PacketLossSimulator(Worker):
         super().__init__(settings)
         self.packet_size = settings.get("packet_size")
 
-    def run(self, num_samples) -> np.ndarray:
+    def run(self, num_samples) -> LostSamplesMask:
         '''
-        This function computes and returns an array of indexes representing
-        the position of lost samples in the original audio track.
+        This function computes and returns the mask of the lost samples of
+        the original audio track. The loss decisions are drawn one chunk of
+        packets at a time and stored as bursts of lost packets.
         '''
-        lost_samples_idx = []
-        lost_packet: bool | None = None
-        for idx in self.progress_monitor(range(num_samples), desc=str(self)):
-            if (idx % self.packet_size) == 0:
-                lost_packet = self.tick()
-            if lost_packet:
-                lost_samples_idx.append(idx)
+        n_packets = ceil(num_samples / self.packet_size)
+        lost_packets_idx = []
+        for start in self.progress_monitor(range(0, n_packets, CHUNK_SIZE), desc=str(self)):
+            lost_packets = self.draw(min(CHUNK_SIZE, n_packets - start))
+            lost_packets_idx.append(np.flatnonzero(lost_packets) + start)
+        lost_packets_idx = np.concatenate(lost_packets_idx) if lost_packets_idx else np.array([], dtype=np.int64)
 
-        return np.array(lost_samples_idx)
+        return LostSamplesMask.from_lost_packets_idx(lost_packets_idx, self.packet_size, num_samples)
 
     def __str__(self) -> str:
         return self.__class__.__name__ + '_s' + str(self.settings.get("seed"))
 
+    def draw(self, n_packets: int) -> np.ndarray:
+        '''
+        This function returns a boolean array with the loss decisions of the
+        next n_packets packets (True if the packet has been lost).
+        Derived classes override it with a vectorized implementation; this
+        one falls back to calling tick() once per packet.
+        '''
+        return np.fromiter((self.tick() for _ in range(n_packets)), dtype=bool, count=n_packets)
+
     def tick(self) -> bool:
         '''
         Placeholder function to be implemented by the derived classes.
@@ -53,7 +67,7 @@ class BinomialPLS(PacketLossSimulator):
     def __init__(self, settings: BinomialPLSSettings) -> None:
         super().__init__(settings)
         self.per = settings.get("per")
-        npr.seed(self.settings.get("seed"))
+        self.random_state = npr.RandomState(self.settings.get("seed"))
 
     def tick(self) -> bool:
         '''
@@ -62,9 +76,16 @@ class BinomialPLS(PacketLossSimulator):
         Output:
             True if the packet has been lost
         '''
-        b_trial_result = npr.random() <= self.per
+        b_trial_result = self.random_state.random_sample() <= self.per
         return b_trial_result
 
+    def draw(self, n_packets: int) -> np.ndarray:
+        '''
+        This function performs n_packets Bernoulli trials at once. The random
+        numbers are consumed in the same order as by tick().
+        '''
+        return self.random_state.random_sample(n_packets) <= self.per
+
 
 class MetronomePLS(PacketLossSimulator):
     '''
@@ -94,6 +115,19 @@ class MetronomePLS(PacketLossSimulator):
             return True
         return False
 
+    def draw(self, n_packets: int) -> np.ndarray:
+        '''
+        This function computes the values taken by the counter in the next
+        n_packets calls to tick() and returns the resulting loss decisions.
+        '''
+        if self.period <= 0 or self.counter >= self.period:
+            # The counter never wraps around: keep the reference implementation.
+            return super().draw(n_packets)
+        counter = self.counter + 1 + np.arange(n_packets)
+        counter = np.where(counter >= 0, counter % self.period, counter)
+        self.counter = int(counter[-1]) if n_packets > 0 else self.counter
+        return (counter >= 0) & (counter < self.duration)
+
 
 class GilbertElliotPLS(PacketLossSimulator):
     '''
@@ -109,7 +143,7 @@ class GilbertElliotPLS(PacketLossSimulator):
     '''
     def __init__(self, settings: GilbertElliotPLSSettings) -> None:
         super().__init__(settings)
-        npr.seed(self.settings.get("seed"))
+        self.random_state = npr.RandomState(self.settings.get("seed"))
         p = settings.get("p")
         r = settings.get("r")
         h = settings.get("h")
@@ -133,13 +167,40 @@ class GilbertElliotPLS(PacketLossSimulator):
             Output:
                 True if the packet has been lost
         ''' 
-        transition = npr.random()
+        transition = self.random_state.random_sample()
         if transition <= self.current_state[1]:
             if self.current_state[0] == 'G':
                 self.current_state = self.state_b
             else:
                 self.current_state = self.state_g
-        loss = npr.random()
+        loss = self.random_state.random_sample()
         if loss <= self.current_state[2]:
             return True
-        return False
\ No newline at end of file
+        return False
+
+    def draw(self, n_packets: int) -> np.ndarray:
+        '''
+        Batched version of tick(). The two random numbers of each packet are
+        drawn at once, in the same order as tick() consumes them. The state
+        of the Markov chain is then resolved jumping from one transition to
+        the next, so the Python loop runs once per change of state instead of
+        once per packet.
+        '''
+        draws = self.random_state.random_sample(2 * n_packets).reshape(n_packets, 2)
+        transitions, losses = draws[:, 0], draws[:, 1]
+        candidates = {'G': np.flatnonzero(transitions <= self.state_g[1]),
+                      'B': np.flatnonzero(transitions <= self.state_b[1])}
+
+        bad = np.zeros(n_packets, dtype=bool)
+        idx = 0
+        while idx < n_packets:
+            state_candidates = candidates[self.current_state[0]]
+            position = np.searchsorted(state_candidates, idx)
+            end = state_candidates[position] if position < len(state_candidates) else n_packets
+            bad[idx:end] = self.current_state[0] == 'B'
+            if end < n_packets:
+                self.current_state = self.state_b if self.current_state[0] == 'G' else self.state_g
+                bad[end] = self.current_state[0] == 'B'
+            idx = end + 1
+
+        return np.where(bad, losses <= self.state_b[2], losses <= self.state_g[2])
\ No newline at end of file
@@ -1,11 +1,13 @@
-from copy import deepcopy
+import time
 from anytree import NodeMixin
 import numpy as np
 
 from plctestbench.worker import Worker
 from plctestbench.file_wrapper import FileWrapper, AudioFile, DataFile
 from plctestbench.settings import Settings
-from plctestbench.utils import dummy_progress_bar
+from plctestbench.utils import get_peak_rss, get_io_counters, compute_hash
+from plctestbench.hashing import HASH_VERSION
+from plctestbench import write_behind
 
 class BaseNode(object):
     pass
@@ -17,17 +19,24 @@ class Node(BaseNode, NodeMixin):
                        absolute_path: str | None = None,
                        parent = None,
                        database = None,
-                       folder_name = None) -> None:
+                       folder_name = None,
+                       paranoid = False,
+                       write_behind = False,
+                       artifact_store = None) -> None:
         self.file = file
-        self.settings = deepcopy(settings)
+        self.settings = settings.derive() if settings is not None else None
         if parent is not None:
             self.settings.inherit_from(parent.settings) #type: ignore
         self.worker = worker(self.settings) if worker is not None else None #type: ignore
         self.database = database
+        self.paranoid = paranoid
+        self.write_behind = write_behind
+        self.artifact_store = artifact_store
         self.parent = parent
         self.folder_name = folder_name
         self.absolute_path = absolute_path
         self.persistent = True
+        self.metrics = None
 
     def set_folder_name(self, folder_name) -> None:
         self.folder_name = folder_name
@@ -62,9 +71,37 @@ class Node(BaseNode, NodeMixin):
     def get_setting(self, setting_name: str):
         return self.settings.get(setting_name) #type: ignore
 
+    def get_num_samples(self) -> int:
+        '''
+        This function returns the number of samples (of all the channels) of
+        the original track, used to measure the throughput of the workers.
+        '''
+        original_track = self.get_original_track()
+        return original_track.get_frames() * original_track.get_channels() #type: ignore
+
     def _get_database(self):
         return self.root.database
 
+    def _get_file_path(self, extension: str) -> str:
+        '''
+        This function returns the path of the file to be written by the node:
+        its path in the artifact store, if any, or its path in the folder tree.
+        '''
+        artifact_store = self.root.artifact_store
+        if artifact_store is None:
+            return self.absolute_path + extension #type: ignore
+        return artifact_store.allocate(self._get_store_key(), extension, self.absolute_path + extension) #type: ignore
+
+    def _get_store_key(self) -> str:
+        '''
+        This function returns the key of the file of the node in the artifact
+        store. The id only depends on the settings, where the original track
+        appears by its name, so the hash of the content of the original track
+        is included: tracks with the same name in different root folders do
+        not share their files.
+        '''
+        return str(compute_hash(str(hash(self.root.get_file())) + self.get_id()))
+
     def _load_from_database(self) -> dict:
         return self._get_database().find_node(self.get_id(), type(self).__name__) #type: ignore
 
@@ -72,39 +109,122 @@ class Node(BaseNode, NodeMixin):
         entry = self.settings.to_dict().copy() #type: ignore
         entry["filepath"] = self.file.get_path() #type: ignore
         entry["_id"] = self.get_id()
+        entry["type"] = type(self).__name__
         entry["file_hash"] = str(hash(self.file))
+        entry["hash_version"] = HASH_VERSION
+        entry.update(self.file.get_stat()) #type: ignore
         entry["parent"] = self.parent.get_id() if self.parent is not None else None
         entry["persistent"] = self.persistent
+        entry["worker"] = type(self.worker).__name__
+        if self.metrics is not None:
+            entry["metrics"] = self.metrics
         self._get_database().add_node(entry, type(self).__name__) #type: ignore
 
+    def _migrate_file_hash(self, current_node: dict) -> None:
+        '''
+        This function replaces the hash stored by a previous version of the
+        testbench with the current one, provided that the file has not changed.
+        '''
+        if self.file is None or str(self.file.get_legacy_hash()) != current_node["file_hash"]:
+            return
+        current_node["file_hash"] = str(hash(self.file))
+        current_node["hash_version"] = HASH_VERSION
+        self._get_database().update_node(self.get_id(), {"file_hash": current_node["file_hash"], "hash_version": HASH_VERSION}, type(self).__name__) #type: ignore
+
+    def _file_stat_matches(self, current_node: dict) -> bool:
+        '''
+        This function returns True if the size, the modification time and
+        the inode of the file are the ones stored in the database.
+        '''
+        if self.file is None:
+            return False
+        try:
+            stat = self.file.get_stat()
+        except OSError:
+            return False
+        return all(current_node.get(key) == value for key, value in stat.items())
+
     def get_id(self) -> str:
         return str(hash(self.settings))
 
     def _run(self):
         pass
 
+    def _measure_run(self) -> None:
+        '''
+        This function runs the worker and stores its measurements in
+        self.metrics:
+            wall_time, cpu_time:        the time spent by _run, in seconds.
+            num_samples:                the number of samples of the track.
+            rss_delta:                  the increase of the peak resident set
+                                        size of the process, in bytes.
+            syscall_read_bytes,
+            syscall_write_bytes:        the bytes read and written by the
+                                        process through system calls, see
+                                        utils.get_io_counters.
+            hash_time:                  the time spent hashing the file.
+        The memory and I/O measurements are None where not available and, as
+        they refer to the whole process, include the other threads. The
+        memory-mapped reads and the writes completed by the write-behind
+        thread after _run returns are not counted.
+        '''
+        start_peak_rss, start_io = get_peak_rss(), get_io_counters()
+        start_wall_time, start_cpu_time = time.perf_counter(), time.process_time()
+        self._run()
+        wall_time, cpu_time = time.perf_counter() - start_wall_time, time.process_time() - start_cpu_time
+        peak_rss, io = get_peak_rss(), get_io_counters()
+        self.metrics = {"cache": "miss",
+                        "wall_time": wall_time,
+                        "cpu_time": cpu_time,
+                        "num_samples": self.get_num_samples(),
+                        "rss_delta": peak_rss - start_peak_rss if peak_rss is not None else None,
+                        "syscall_read_bytes": io["syscall_read_bytes"] - start_io["syscall_read_bytes"] if io is not None else None,
+                        "syscall_write_bytes": io["syscall_write_bytes"] - start_io["syscall_write_bytes"] if io is not None else None,
+                        "hash_time": self.file.hash_time} #type: ignore
+
     def run(self):
 
         # Load from database if possible, otherwise run the worker
+        start_wall_time = time.perf_counter()
         current_node = self._load_from_database()
         if current_node:
             self.persistent = current_node["persistent"]
         if self.persistent is False or current_node is None:
-            self._run()
-            self._save_to_database()
-        else:
-            self.file = FileWrapper.from_path(current_node["filepath"])
-
-            # Manage consistency between database and filesystem
-            if str(hash(self.file)) != current_node["file_hash"]:
-                if self.parent is None:
-                    raise Exception("The following audio file has changed: " + self.file.get_path()) #type: ignore
-                else:
-                    self._get_database().delete_node(self.get_id()) #type: ignore
-                    self.run()
+            self._measure_run()
+            # The document is queued after the write of the file, so that it
+            # is stored only once the file is on disk
+            if self.write_behind:
+                write_behind.submit(self._save_to_database)
             else:
-                # Dummy progress bar needed when not running the worker
-                dummy_progress_bar(self.worker)
+                self._save_to_database()
+        else:
+            self.file = FileWrapper.from_path(current_node["filepath"], lazy=True)
+
+            # Manage consistency between database and filesystem: the file is
+            # hashed only if its stat changed, unless running in paranoid mode
+            fields = {}
+            if self.paranoid or not self._file_stat_matches(current_node):
+                if current_node.get("hash_version") != HASH_VERSION:
+                    self._migrate_file_hash(current_node)
+                if str(hash(self.file)) != current_node["file_hash"]:
+                    if self.parent is None:
+                        raise Exception("The following audio file has changed: " + self.file.get_path()) #type: ignore
+                    else:
+                        self._get_database().delete_node(self.get_id(), type(self).__name__) #type: ignore
+                        self.run()
+                        return
+                fields.update(self.file.get_stat()) #type: ignore
+            elif current_node.get("hash_version") == HASH_VERSION:
+                # The file is unchanged, so its hash is the stored one
+                self.file.hash = int(current_node["file_hash"]) #type: ignore
+
+            # The measurements of a cache hit are only reported to the progress
+            # sink: the document is updated only if the stat of the file changed
+            self.metrics = {"cache": "hit",
+                            "wall_time": time.perf_counter() - start_wall_time,
+                            "hash_time": self.file.hash_time} #type: ignore
+            if fields:
+                self._get_database().update_node(self.get_id(), fields, type(self).__name__) #type: ignore
     
     def __str__(self) -> str:
         return "file: " + str(self.file) + '\n' +\
@@ -120,15 +240,21 @@ class OriginalTrackNode(Node):
                  absolute_path=None,
                  parent=None,
                  database=None,
-                 folder_name=None) -> None:
+                 folder_name=None,
+                 paranoid=False,
+                 write_behind=False,
+                 artifact_store=None) -> None:
         super().__init__(file=file,
                          worker=worker,
                          settings=settings,
                          absolute_path=absolute_path,
                          parent=parent,
                          database=database,
-                         folder_name=folder_name)
-        self.file = AudioFile(path=self.absolute_path + '.wav') #type: ignore
+                         folder_name=folder_name,
+                         paranoid=paranoid,
+                         write_behind=write_behind,
+                         artifact_store=artifact_store)
+        self.file = AudioFile(path=self.absolute_path + '.wav', lazy=True) #type: ignore
         self.settings.add('fs', self.file.get_samplerate()) #type: ignore
 
     def get_data(self) -> np.ndarray:
@@ -149,14 +275,20 @@ class LostSamplesMaskNode(Node):
                  absolute_path=None,
                  parent=None,
                  database=None,
-                 folder_name=None) -> None:
+                 folder_name=None,
+                 paranoid=False,
+                 write_behind=False,
+                 artifact_store=None) -> None:
         super().__init__(file=file,
                          worker=worker,
                          settings=settings,
                          absolute_path=absolute_path,
                          parent=parent,
                          database=database,
-                         folder_name=folder_name)
+                         folder_name=folder_name,
+                         paranoid=paranoid,
+                         write_behind=write_behind,
+                         artifact_store=artifact_store)
 
     def get_data(self) -> np.ndarray:
         return self.file.get_data() #type: ignore
@@ -165,11 +297,10 @@ class LostSamplesMaskNode(Node):
         return self.root #type: ignore
 
     def _run(self) -> None:
-        original_track_data = self.get_original_track().get_data() #type: ignore
-        num_samples = len(original_track_data) #type: ignore
-        lost_samples_idx = self.get_worker().run(num_samples) #type: ignore
+        num_samples = self.get_original_track().get_frames() #type: ignore
+        lost_samples_mask = self.get_worker().run(num_samples) #type: ignore
         self.persistent = self.get_worker().is_persistent() #type: ignore
-        self.file = DataFile(lost_samples_idx, self.absolute_path + '.npy') #type: ignore
+        self.file = DataFile(lost_samples_mask, self._get_file_path('.npy'), background=self.write_behind) #type: ignore
 
 class ReconstructedTrackNode(Node):
     def __init__(self, file=None,
@@ -177,14 +308,20 @@ class ReconstructedTrackNode(Node):
                  settings=None,
                  absolute_path=None,
                  parent=None, database=None,
-                 folder_name=None) -> None:
+                 folder_name=None,
+                 paranoid=False,
+                 write_behind=False,
+                 artifact_store=None) -> None:
         super().__init__(file=file,
                          worker=worker,
                          settings=settings,
                          absolute_path=absolute_path,
                          parent=parent,
                          database=database,
-                         folder_name=folder_name)
+                         folder_name=folder_name,
+                         paranoid=paranoid,
+                         write_behind=write_behind,
+                         artifact_store=artifact_store)
 
     def get_data(self) -> np.ndarray:
         return self.file.get_data() #type: ignore
@@ -198,14 +335,14 @@ class ReconstructedTrackNode(Node):
     def _run(self) -> None:
         original_track = self.get_original_track()
         original_track_data = original_track.get_data() #type: ignore
-        lost_samples_idx = self.get_lost_samples_mask().get_data()
-        reconstructed_track = self.get_worker().run(original_track_data, lost_samples_idx) #type: ignore
+        lost_samples_mask = self.get_lost_samples_mask().get_data()
+        reconstructed_track = self.get_worker().run(original_track_data, lost_samples_mask) #type: ignore
         self.persistent = self.get_worker().is_persistent() #type: ignore
-        self.file = AudioFile.from_audio_file(original_track, reconstructed_track, self.absolute_path + '.wav') #type: ignore
+        self.file = AudioFile.from_audio_file(original_track, reconstructed_track, self._get_file_path('.wav'), background=self.write_behind) #type: ignore
 
 class OutputAnalysisNode(Node):
-    def __init__(self, file=None, worker=None, settings=None, absolute_path=None, parent=None, database=None, folder_name=None) -> None:
-        super().__init__(file=file, worker=worker, settings=settings, absolute_path=absolute_path, parent=parent, database=database, folder_name=folder_name)
+    def __init__(self, file=None, worker=None, settings=None, absolute_path=None, parent=None, database=None, folder_name=None, paranoid=False, write_behind=False, artifact_store=None) -> None:
+        super().__init__(file=file, worker=worker, settings=settings, absolute_path=absolute_path, parent=parent, database=database, folder_name=folder_name, paranoid=paranoid, write_behind=write_behind, artifact_store=artifact_store)
 
     def get_data(self) -> np.ndarray:
         return self.file.get_data() #type: ignore
@@ -222,7 +359,7 @@ class OutputAnalysisNode(Node):
     def _run(self) -> None:
         original_track = self.get_original_track()
         reconstructed_track = self.get_reconstructed_track()
-        lost_samples_idx = self.get_lost_samples_mask()
-        output_analysis = self.get_worker().run(original_track, reconstructed_track, lost_samples_idx) #type: ignore
+        lost_samples_mask = self.get_lost_samples_mask()
+        output_analysis = self.get_worker().run(original_track, reconstructed_track, lost_samples_mask) #type: ignore
         self.persistent = self.get_worker().is_persistent() #type: ignore
-        self.file = DataFile(output_analysis, self.absolute_path + '.pickle') #type: ignore
+        self.file = DataFile(output_analysis, self._get_file_path('.pickle'), background=self.write_behind) #type: ignore
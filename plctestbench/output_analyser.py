@@ -3,7 +3,7 @@ import numpy as np
 import numpy.random as npr
 from .settings import Settings, PEAQMode
 from .worker import Worker
-from .file_wrapper import SimpleCalculatorData, PEAQData, AudioFile, DataFile
+from .file_wrapper import SimpleCalculatorData, PEAQData, AudioFile, DataFile, LostSamplesMask
 from .utils import dummy_progress_bar, extract_intorni, force_single_loss_per_stimulus, relative_to_root, is_loud_enough
 from .perceptual_metric import *
 from .listening_tests import ListeningTest
@@ -156,12 +156,10 @@ class PEAQCalculator(OutputAnalyser):
         new_path = path[:-4] + "_norm" + path[-4:]
         new_data = normalise(original_track_node.get_data())
         original_track_norm_file = AudioFile.from_audio_file(original_track_node, new_data=new_data, new_path=new_path)
-        original_track_norm_file.save()
         path = reconstructed_track_node.get_path()
         new_path = path[:-4] + "_norm" + path[-4:]
         new_data = normalise(reconstructed_track_node.get_data())
         reconstructed_track_norm_file = AudioFile.from_audio_file(reconstructed_track_node, new_data=new_data, new_path=new_path)
-        reconstructed_track_norm_file.save()
 
         if mode_flag == '':
             completed_process = subprocess.run(["peaq", "--gst-plugin-path", "/usr/lib/gstreamer-1.0/", original_track_norm_file.get_path(),
@@ -214,22 +212,20 @@ class WindowedPEAQCalculator(OutputAnalyser):
         new_path = path[:-4] + "_norm" + path[-4:]
         new_data = normalise(original_track_node.get_data())
         original_track_norm_file = AudioFile.from_audio_file(original_track_node, new_data=new_data, new_path=new_path)
-        original_track_norm_file.save()
         path = reconstructed_track_node.get_path()
         new_path = path[:-4] + "_norm" + path[-4:]
         new_data = normalise(reconstructed_track_node.get_data())
         reconstructed_track_norm_file = AudioFile.from_audio_file(reconstructed_track_node, new_data=new_data, new_path=new_path)
-        reconstructed_track_norm_file.save()
 
-        lost_samples_idxs = lost_samples_idxs_data.get_data()
-        intorni_original = extract_intorni(original_track_norm_file, lost_samples_idxs, self.intorno_length, self.fs, self.packet_size)
-        intorni_reconstructed = extract_intorni(reconstructed_track_norm_file, lost_samples_idxs, self.intorno_length, self.fs, self.packet_size)
+        lost_samples_mask = LostSamplesMask.from_data(lost_samples_idxs_data.get_data(), self.packet_size, original_track_node.get_frames())
+        intorni_original = extract_intorni(original_track_norm_file, lost_samples_mask, self.intorno_length, self.fs, self.packet_size)
+        intorni_reconstructed = extract_intorni(reconstructed_track_norm_file, lost_samples_mask, self.intorno_length, self.fs, self.packet_size)
 
         path = original_track_node.get_path()
         original_path = path[:-4] + "_chunk" + path[-4:]
         path = reconstructed_track_node.get_path()
         reconstructed_path = path[:-4] + "_chunk" + path[-4:]
-        metric = np.zeros(len(original_track_node.get_data()) // self.packet_size)
+        metric = np.zeros(original_track_node.get_frames() // self.packet_size)
 
         for idx, (intorno_original, intorno_reconstructed) in enumerate(zip(intorni_original[1], intorni_reconstructed[1])):
             # Prüfe Chunk-Länge
@@ -240,8 +236,6 @@ class WindowedPEAQCalculator(OutputAnalyser):
 
             original_intorno_file = AudioFile.from_audio_file(original_track_norm_file, new_data=intorno_original, new_path=original_path)
             reconstructed_intorno_file = AudioFile.from_audio_file(reconstructed_track_norm_file, new_data=intorno_reconstructed, new_path=reconstructed_path)
-            original_intorno_file.save()
-            reconstructed_intorno_file.save()
 
             completed_process = subprocess.run(
                 ["peaq", self.mode_flag, "--gst-plugin-path", "/usr/lib/gstreamer-1.0/",
@@ -297,9 +291,9 @@ class PerceptualCalculator(OutputAnalyser):
         self.metric = self.settings.get("metric")
 
     def run(self, original_track_node: AudioFile, reconstructed_track_node: AudioFile, lost_samples_idxs_data: DataFile = None):
-        lost_samples_idxs = lost_samples_idxs_data.get_data()
-        intorni_original = extract_intorni(original_track_node, lost_samples_idxs, self.intorno_length, self.fs, self.packet_size)
-        intorni_reconstructed = extract_intorni(reconstructed_track_node, lost_samples_idxs, self.intorno_length, self.fs, self.packet_size)
+        lost_samples_mask = LostSamplesMask.from_data(lost_samples_idxs_data.get_data(), self.packet_size, original_track_node.get_frames())
+        intorni_original = extract_intorni(original_track_node, lost_samples_mask, self.intorno_length, self.fs, self.packet_size)
+        intorni_reconstructed = extract_intorni(reconstructed_track_node, lost_samples_mask, self.intorno_length, self.fs, self.packet_size)
         
         if intorni_original[1][0].ndim == 1:
             input_size = len(intorni_original[1][0])
@@ -331,9 +325,9 @@ class PerceptualCalculator(OutputAnalyser):
                     spectrograms.append({'idx': (idx, channel), **pm.spectrogram(original[:, channel], reconstructed[:, channel])})
 
         if intorni_original[1][0].ndim == 1:
-            metric = np.zeros(len(original_track_node.get_data()) // self.packet_size)
+            metric = np.zeros(original_track_node.get_frames() // self.packet_size)
         else:
-            metric = np.zeros((len(original_track_node.get_data()) // self.packet_size, 2))
+            metric = np.zeros((original_track_node.get_frames() // self.packet_size, 2))
 
         for spectrogram in spectrograms:
             perc_metric = pm(spectrogram)
@@ -369,12 +363,13 @@ class HumanCalculator(OutputAnalyser):
 
         self.listening_test = ListeningTest(self.settings)
 
+        all_lost_samples_mask = LostSamplesMask.from_data(lost_samples_idxs_data.get_data(), self.packet_size, original_track_node.get_frames())
         if self.single_loss:
-            lost_samples_idxs = force_single_loss_per_stimulus(lost_samples_idxs_data.get_data(), self.fs, self.stimulus_length/2, self.packet_size)
+            lost_samples_mask = force_single_loss_per_stimulus(all_lost_samples_mask, self.fs, self.stimulus_length/2, self.packet_size)
         else:
-            lost_samples_idxs = lost_samples_idxs_data.get_data()
-        intorni_original = extract_intorni(original_track_node, lost_samples_idxs, self.stimulus_length, self.fs, self.packet_size, unique=True)
-        intorni_reconstructed = extract_intorni(reconstructed_track_node, lost_samples_idxs, self.stimulus_length, self.fs, self.packet_size, unique=True)
+            lost_samples_mask = all_lost_samples_mask
+        intorni_original = extract_intorni(original_track_node, lost_samples_mask, self.stimulus_length, self.fs, self.packet_size, unique=True)
+        intorni_reconstructed = extract_intorni(reconstructed_track_node, lost_samples_mask, self.stimulus_length, self.fs, self.packet_size, unique=True)
 
         intorni_original_loud = []
         intorni_reconstructed_loud = []
@@ -389,7 +384,7 @@ class HumanCalculator(OutputAnalyser):
         if self.stimuli_number > len(intorni_original_loud[1]):
             error_message = (f"The number of stimuli requested ({self.stimuli_number}) is greater than the number of stimuli available "
                              f"({len(intorni_original_loud)}). Increase the total length of available audio.")
-            discarded_packets_close = (len(lost_samples_idxs_data.get_data()) - len(lost_samples_idxs)) // self.packet_size
+            discarded_packets_close = all_lost_samples_mask.get_num_lost_packets() - lost_samples_mask.get_num_lost_packets()
             if discarded_packets_close > 0:
                 error_message += f" {discarded_packets_close} stimulus were discarded because too close to each other."
             discarded_packet_loud = len(intorni_original[1]) - len(intorni_original_loud[1])
@@ -409,7 +404,7 @@ class HumanCalculator(OutputAnalyser):
         self.listening_test.generate_config()
         results =  self.listening_test.get_results()
 
-        metric = np.zeros(len(original_track_node.get_data())//self.packet_size)
+        metric = np.zeros(original_track_node.get_frames()//self.packet_size)
 
         string_to_int_map = {}
         next_available_index = len(metric)  # Startindex für Strings (nach den numerischen Indizes)
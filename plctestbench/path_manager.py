@@ -1,28 +1,16 @@
 import os
 from os import path
 import glob as gb
+from concurrent.futures import ThreadPoolExecutor
 from plctestbench.node import Node
 
 folder_suffixes = ['lost_samples_masks',
                    'reconstructed_tracks',
                    'output_analyses']
 
-def compute_absolute_folder_path(parent: Node) -> str:
-    '''
-    This private function computes the absolute path of the given node climbing down the ancestors list.
-
-        Inputs:
-            node:   the node instance to compute the absolute path for
-    '''
-    folder_path = ""
-    for ancestor in parent.ancestors:
-        folder_path = path.join(folder_path, ancestor.get_folder_name())
-    folder_path = path.join(folder_path, parent.get_folder_name())
-    return folder_path
-
 class PathManager(object):
 
-    def __init__(self, root_folder) -> None:
+    def __init__(self, root_folder, folder_threads: int = 1) -> None:
         '''
         This class defines and creates the folder structure used to store
         all the data of the program. It also provides utility functions
@@ -30,8 +18,13 @@ class PathManager(object):
 
             Inputs:
                 root_folder:    The root folder where all the files will be created
+                folder_threads: The number of threads creating the folders,
+                                see create_folders
         '''
         self.root_folder = root_folder
+        self.folder_threads = folder_threads
+        # Folders to be created by create_folders, for each depth
+        self.pending_folders = {}
         if not path.exists(root_folder):
             print("The folder %s does not exist", root_folder)
             return
@@ -43,8 +36,8 @@ class PathManager(object):
 
     def _set_root_node_path(self, settings) -> tuple:
         '''
-        This function computes the absolute path of the root node, creates
-        its directory and stores it in the node.
+        This function computes the absolute path of the root node and queues
+        the creation of its directory.
 
             Inputs:
                 node:   the node instance to compute the absolute path for
@@ -52,14 +45,25 @@ class PathManager(object):
         track_path = self.root_folder + '/' + settings.get('filename')
         folder_name = track_path.split('.wav')[0] + '-' + folder_suffixes[0]
         absolute_path = track_path.split('.wav')[0]
-        if not path.exists(folder_name):
-            os.mkdir(folder_name)
+        self.pending_folders.setdefault(0, []).append(folder_name)
         return folder_name, absolute_path
 
+    @staticmethod
+    def get_folder_path(node: Node) -> str:
+        '''
+        This function returns the path of the folder containing the files of
+        the children of the given node. It is derived from the absolute path
+        of the node, without climbing the ancestors list.
+
+            Inputs:
+                node:   the node instance to compute the folder path for
+        '''
+        return node.absolute_path + '-' + folder_suffixes[node.depth] #type: ignore
+
     def get_node_paths(self, worker, settings, parent: Node | None) -> tuple:
         '''
-        This function computes the relative path of the node, creates its
-        directory and stores it in the node.
+        This function computes the relative path of the node and queues the
+        creation of its directory, see create_folders.
 
         Inputs:
             node:   the node instance to compute the relative path for
@@ -69,16 +73,33 @@ class PathManager(object):
         
         folder_name = None
         index = parent.depth + 1
-        node_path = compute_absolute_folder_path(parent)
+        node_path = self.get_folder_path(parent)
         worker_name = worker.__name__ + '-' + str(hash(settings))
         absolute_path = path.join(node_path, worker_name)
         if index < len(folder_suffixes):
             folder_name = worker_name + '-' + folder_suffixes[index]
-            folder_path = path.join(node_path, folder_name)
-            if not path.exists(folder_path):
-                os.mkdir(folder_path)
+            self.pending_folders.setdefault(index, []).append(path.join(node_path, folder_name))
         return folder_name, absolute_path
 
+    def create_folders(self) -> None:
+        '''
+        This function creates the directories queued by get_node_paths, one
+        depth at a time so that every folder is created after its parent.
+        The folders of the same depth are created by folder_threads threads,
+        which hides the latency of network filesystems.
+        '''
+        def create_folder(folder_path: str) -> None:
+            try:
+                os.mkdir(folder_path)
+            except FileExistsError:
+                pass
+
+        pending_folders, self.pending_folders = self.pending_folders, {}
+        with ThreadPoolExecutor(max_workers=max(self.folder_threads, 1)) as executor:
+            for depth in sorted(pending_folders.keys()):
+                # list() waits for the folders of this depth and raises their errors
+                list(executor.map(create_folder, pending_folders[depth]))
+
     @staticmethod
     def change_file_extension(filepath: str, new_extension: str) -> str:
         '''
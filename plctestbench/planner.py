@@ -0,0 +1,160 @@
+from anytree import PostOrderIter
+from plctestbench.node import Node
+from plctestbench.file_wrapper import FileWrapper
+
+class ExecutionPlan(object):
+    '''
+    This class describes which nodes of a run are already materialized,
+    i.e. stored in the database with an unchanged file, and which ones have
+    to be computed, before running them.
+
+        Variables:
+            nodes_to_compute:   the nodes that will be computed.
+            cached_nodes:       the nodes that will be loaded from the database.
+            pruned_nodes:       the cached nodes whose whole subtree is cached:
+                                they are not run at all.
+            saved_time:         the time spent computing the cached nodes, in
+                                seconds, for the nodes that recorded it.
+            cpu_time:           the estimated CPU time of the nodes to compute,
+                                in seconds, for each worker (see estimate).
+            unknown_cpu_time:   the number of nodes to compute without an
+                                estimated CPU time, for each worker.
+            disk_usage:         the estimated size of the files to be written,
+                                in bytes.
+    '''
+    def __init__(self, nodes_to_compute: list,
+                       cached_nodes: list,
+                       pruned_nodes: set,
+                       saved_time: float) -> None:
+        self.nodes_to_compute = nodes_to_compute
+        self.cached_nodes = cached_nodes
+        self.pruned_nodes = pruned_nodes
+        self.saved_time = saved_time
+        self.cpu_time = None
+        self.unknown_cpu_time = None
+        self.disk_usage = None
+
+    def is_pruned(self, node: Node) -> bool:
+        return node in self.pruned_nodes
+
+    def get_counts(self) -> dict:
+        '''
+        This function returns the number of nodes to be computed for each
+        type of node.
+        '''
+        counts = {}
+        for node in self.nodes_to_compute:
+            counts[type(node).__name__] = counts.get(type(node).__name__, 0) + 1
+        return counts
+
+    def estimate(self, statistics: dict) -> None:
+        '''
+        This function estimates the CPU time and the disk usage of the nodes
+        to compute from the length of the tracks and from the throughput of
+        the workers recorded in the database. The throughput measured with
+        the same packet size is used when available.
+
+            Inputs:
+                statistics: the totals of the metrics of the nodes for each
+                            worker and packet size, see
+                            DatabaseManager.get_worker_statistics.
+        '''
+        worker_statistics = {}
+        for (worker, _), group in statistics.items():
+            total = worker_statistics.setdefault(worker, {"wall_time": 0., "cpu_time": 0., "num_samples": 0, "file_size": 0, "count": 0})
+            for field in total:
+                total[field] += group[field] or 0
+
+        self.cpu_time = {}
+        self.unknown_cpu_time = {}
+        self.disk_usage = 0
+        for node in self.nodes_to_compute:
+            worker = type(node.get_worker()).__name__
+            packet_size = node.settings.get_all().get("packet_size") #type: ignore
+            group = statistics.get((worker, packet_size), worker_statistics.get(worker))
+            num_samples = node.get_num_samples()
+            if group is not None and group["cpu_time"] and group["num_samples"]:
+                self.cpu_time[worker] = self.cpu_time.get(worker, 0.) + num_samples * group["cpu_time"] / group["num_samples"]
+            else:
+                self.unknown_cpu_time[worker] = self.unknown_cpu_time.get(worker, 0) + 1
+            if node.depth == 0:
+                # The original tracks are already on disk
+                continue
+            if group is not None and group["num_samples"]:
+                self.disk_usage += int(num_samples * group["file_size"] / group["num_samples"])
+            elif node.depth == 2:
+                # A reconstructed track has the same format as the original one
+                self.disk_usage += node.get_original_track().get_stat()["file_size"] #type: ignore
+
+    def __str__(self) -> str:
+        counts = ", ".join(name + ": " + str(count) for name, count in self.get_counts().items())
+        description = "Nodes to compute: " + str(len(self.nodes_to_compute)) + (" (" + counts + ")" if counts else "") + '\n' +\
+                      "Cached nodes: " + str(len(self.cached_nodes)) + " (" + str(len(self.pruned_nodes)) + " skipped)" + '\n' +\
+                      "Time saved: %.1f s" % self.saved_time
+        if self.cpu_time is not None:
+            cpu_times = ["%s: %.1f s" % (worker, cpu_time) for worker, cpu_time in self.cpu_time.items()]
+            cpu_times += ["%s: unknown (%d nodes)" % (worker, count) for worker, count in self.unknown_cpu_time.items()]
+            description += '\n' + "Estimated CPU time: %.1f s" % sum(self.cpu_time.values()) + (" (" + ", ".join(cpu_times) + ")" if cpu_times else "") + '\n' +\
+                           "Estimated disk usage: %.1f MB" % (self.disk_usage / 1e6)
+        return description
+
+def _get_cached_file(current_node: dict) -> FileWrapper | None:
+    '''
+    This function returns the file of a node stored in the database, if its
+    size, modification time and inode are the ones stored with the node.
+    '''
+    file = FileWrapper.from_path(current_node["filepath"], lazy=True)
+    if file is None:
+        return None
+    try:
+        stat = file.get_stat()
+    except OSError:
+        return None
+    if not all(current_node.get(key) == value for key, value in stat.items()):
+        return None
+    return file
+
+def plan_execution(subtrees: list, database, paranoid: bool = False) -> ExecutionPlan:
+    '''
+    This function resolves which nodes of the given subtrees are already
+    materialized. The documents are expected to be prefetched, see
+    DatabaseManager.prefetch_nodes. The subtrees that are entirely cached are
+    pruned: their nodes get their file from the database and are not run.
+    The nodes whose file has a different stat are planned to be computed,
+    although Node.run keeps them if the hash of the file has not changed.
+    In paranoid mode the files have to be hashed by Node.run, so nothing is
+    pruned.
+
+        Inputs:
+            subtrees:   the root nodes of the subtrees to be run.
+            database:   the database manager.
+            paranoid:   whether the files are always hashed.
+    '''
+    nodes_to_compute = []
+    cached_nodes = []
+    cached_files = {}
+    saved_time = 0.
+    for subtree in subtrees:
+        for node in PostOrderIter(subtree):
+            current_node = database.find_node(node.get_id(), type(node).__name__)
+            file = None
+            if current_node is not None and current_node["persistent"] is not False:
+                file = _get_cached_file(current_node)
+            if file is None:
+                nodes_to_compute.append(node)
+                continue
+            cached_nodes.append(node)
+            cached_files[node] = file
+            saved_time += current_node.get("metrics", {}).get("wall_time", 0.)
+
+    pruned_nodes = set()
+    if not paranoid:
+        for node in cached_nodes:
+            if all(descendant in cached_files for descendant in node.descendants):
+                node.set_file(cached_files[node])
+                pruned_nodes.add(node)
+
+    # Reverse the post-order, so that the nodes are listed parents first
+    nodes_to_compute.reverse()
+    cached_nodes.reverse()
+    return ExecutionPlan(nodes_to_compute, cached_nodes, pruned_nodes, saved_time)
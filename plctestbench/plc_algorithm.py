@@ -1,6 +1,9 @@
-from math import ceil
+from math import ceil, gcd
+from itertools import chain
 import librosa
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import resample_poly, get_window
 from burg_plc import BurgBasic
 from cpp_plc_template import BasePlcTemplate
 import tensorflow as tf
@@ -10,6 +13,8 @@ from .low_cost_concealment import LowCostConcealment
 from .crossfade import Crossfade, MultibandCrossfade
 from .filters import LinkwitzRileyCrossover
 from .spatial import MidSideCodec, CodecMode
+from .file_wrapper import LostSamplesMask
+from .context_buffer import ContextBuffer
 from .utils import recursive_split_audio, get_class, force_2d, prepare_progress_monitor
 
 class PLCAlgorithm(Worker):
@@ -35,41 +40,90 @@ class PLCAlgorithm(Worker):
 
     
 
-    def run(self, original_track: np.ndarray, lost_samples_idx: np.ndarray):
+    @property
+    def context(self) -> np.ndarray:
+        '''
+        The last context_length samples of the reconstructed track.
+        '''
+        return self._context_buffer.get()
+
+    @context.setter
+    def context(self, context: np.ndarray) -> None:
+        self._context_buffer = ContextBuffer(context)
+
+    def run(self, original_track: np.ndarray, lost_samples_mask: LostSamplesMask):
         '''
         This method processes an audio track and performs Packet Loss Concealment.
-        It splits the signal into packets, checks for each packet whether it was lost (based on lost_samples_idx),
-        and reconstructs the packet if necessary using the PLC logic. Finally, the reconstructed signal is returned.
+        It walks the bursts of lost packets of lost_samples_mask: each lost packet,
+        and each valid packet received while a crossfade is ongoing, goes through
+        the PLC logic one packet at a time, while the other runs of valid packets
+        are copied in bulk when the algorithm allows it (see _supports_bulk_copy).
+        Finally, the reconstructed signal is returned.
         '''
-        def zero_pad(original_track: np.ndarray):
-            '''
-            Pads the signal with zeros so that its length is a multiple of the packet size.
-            '''
-            rounding_difference = self.packet_size - track_length % self.packet_size
-            npad = ((0, rounding_difference),(0, 0))
-            return np.pad(original_track, npad, 'constant')
-        
         original_track = force_2d(original_track)
         self.n_channels = np.shape(original_track)[1]
-        lost_packets_idx = lost_samples_idx[::self.packet_size]/self.packet_size
         track_length = len(original_track)
         n_packets = ceil(track_length/self.packet_size)
-        original_track = zero_pad(original_track)
-        reconstructed_track = np.zeros(np.shape(original_track), np.float32)
+        n_full_packets = track_length // self.packet_size
+        lost_samples_mask = LostSamplesMask.from_data(lost_samples_mask, self.packet_size, track_length)
+        reconstructed_track = np.empty((n_packets*self.packet_size, self.n_channels), np.float32)
+        bulk_copy = self._supports_bulk_copy()
         self._prepare_to_play()
-        
-        j = 0
-        for i in self.progress_monitor(range(n_packets), desc=str(self)):
-            if i > lost_packets_idx[j] and j < len(lost_packets_idx) - 1: j += 1
-            start_idx = i*self.packet_size
-            end_idx = (i+1)*self.packet_size
-            buffer = original_track[start_idx:end_idx]
-            is_valid = not i == lost_packets_idx[j]
-            reconstructed_buffer = self._tick(buffer, is_valid)
-            reconstructed_track[start_idx:end_idx] = reconstructed_buffer
+
+        progress_monitor = self.progress_monitor(total=n_packets, desc=str(self))
+        packet_idx = 0
+        for burst_start, burst_length in chain(lost_samples_mask.bursts(), [(n_packets, 0)]):
+            burst_start = min(burst_start, n_packets)
+            burst_end = min(burst_start + burst_length, n_packets)
+            run_start = packet_idx
+            while packet_idx < burst_start:
+                if bulk_copy and packet_idx < n_full_packets and not self.crossfade.ongoing():
+                    run_end = min(burst_start, n_full_packets)
+                    self._copy_valid_packets(original_track, reconstructed_track, packet_idx, run_end)
+                    packet_idx = run_end
+                else:
+                    self._tick_packet(original_track, reconstructed_track, packet_idx, True)
+                    packet_idx += 1
+            while packet_idx < burst_end:
+                self._tick_packet(original_track, reconstructed_track, packet_idx, False)
+                packet_idx += 1
+            progress_monitor.update(packet_idx - run_start)
+        progress_monitor.close()
 
         return reconstructed_track[:track_length]
 
+    def _supports_bulk_copy(self) -> bool:
+        '''
+        Runs of valid packets can be copied in bulk only when the algorithm
+        does not process the valid packets itself, i.e. when it overrides
+        neither _tick nor _a_priori. In that case _a_posteriori receives the
+        whole run at once.
+        '''
+        return type(self)._tick is PLCAlgorithm._tick and type(self)._a_priori is PLCAlgorithm._a_priori
+
+    def _copy_valid_packets(self, original_track: np.ndarray, reconstructed_track: np.ndarray, start_packet: int, end_packet: int) -> None:
+        '''
+        This function copies a run of complete valid packets to the
+        reconstructed track and appends it to the context.
+        '''
+        start_idx = start_packet*self.packet_size
+        end_idx = end_packet*self.packet_size
+        buffer = original_track[start_idx:end_idx]
+        reconstructed_track[start_idx:end_idx] = buffer
+        self._a_posteriori(buffer, True)
+
+    def _tick_packet(self, original_track: np.ndarray, reconstructed_track: np.ndarray, packet_idx: int, is_valid: bool) -> None:
+        '''
+        This function processes a single packet, zero-padding it if it is
+        the last, incomplete, packet of the track.
+        '''
+        start_idx = packet_idx*self.packet_size
+        end_idx = (packet_idx+1)*self.packet_size
+        buffer = original_track[start_idx:end_idx]
+        if len(buffer) < self.packet_size:
+            buffer = np.pad(buffer, ((0, self.packet_size - len(buffer)), (0, 0)), 'constant')
+        reconstructed_track[start_idx:end_idx] = self._tick(buffer, is_valid)
+
     def _prepare_to_play(self):
         '''
         Not all the PLC algorithms need to prepare to play.
@@ -102,10 +156,10 @@ class PLCAlgorithm(Worker):
 
     def _a_posteriori(self, buffer: np.ndarray, is_valid: bool) -> np.ndarray:
         '''
-        This function is called for every buffer.
+        This function is called for every buffer, or once for a whole
+        run of valid packets copied in bulk.
         '''
-        self.context = np.roll(self.context, -self.packet_size, axis=1)
-        self.context[-self.packet_size:, :] = buffer
+        self._context_buffer.push(buffer)
         return buffer
 
     def _fade_in(self, buffer: np.ndarray) -> np.ndarray:
@@ -157,7 +211,7 @@ class AdvancedPLC(PLCAlgorithm):
         self.mid_side = True if self.stereo_image_processing == StereoImageType.mid_side else False
         self.mid_side_codec = MidSideCodec()
 
-    def run(self, original_track: np.ndarray, lost_samples_idx: np.ndarray):
+    def run(self, original_track: np.ndarray, lost_samples_mask: LostSamplesMask):
         '''
         
         '''
@@ -183,7 +237,7 @@ class AdvancedPLC(PLCAlgorithm):
             for idx, plc_algorithm in enumerate(plc_algorithms):
                 plc_algorithm.set_progress_monitor(composite_progress_monitor)
                 progress_monitor.set_description(f"{self} - {channel} - {plc_algorithm}")
-                reconstructed_track_bands[channel] += plc_algorithm.run(processed_track[channel][idx], lost_samples_idx)
+                reconstructed_track_bands[channel] += plc_algorithm.run(processed_track[channel][idx], lost_samples_mask)
         progress_monitor.set_description(f"{self}")
         progress_monitor.close()
         if not self.channel_link:
@@ -337,10 +391,40 @@ class DeepLearningPLC(PLCAlgorithm):
         self.upper_edge_hertz = settings.get("upper_edge_hertz")
         self.num_mel_bins = settings.get("num_mel_bins")
         self.sample_rate = settings.get("fs")
+        self.batched = settings.get("batched") if settings.has("batched") else False
+        if self.batched:
+            divisor = gcd(int(self.sample_rate), int(self.fs_dl))
+            self.up = int(self.fs_dl) // divisor
+            self.down = int(self.sample_rate) // divisor
+            # Number of input samples on each side of an output sample used by resample_poly
+            self.half_length = ceil(10 * max(self.up, self.down) / self.up) + 1
+            self.mel_basis = librosa.filters.mel(sr=self.fs_dl, n_fft=self.window_length, n_mels=self.num_mel_bins,
+                                                 fmin=self.lower_edge_hertz, fmax=self.upper_edge_hertz)
+            self.window = get_window('hann', self.window_length, fftbins=True)
+
+    def _prepare_to_play(self):
+        super()._prepare_to_play()
+        if self.batched:
+            self.history = ContextBuffer(np.zeros((self.context_length + 2 * self.half_length + self.down, self.n_channels)))
+            self.history_end = 0
+            self.context_dl = ContextBuffer(np.zeros((ceil(self.context_length * self.up / self.down), self.n_channels)))
+            # The resampled samples preceding the track by less than the length of the filter are not zero
+            self.context_dl_end = -(self.half_length * self.up // self.down + 1)
+
+    def _a_posteriori(self, buffer: np.ndarray, is_valid: bool) -> np.ndarray:
+        '''
+        '''
+        super()._a_posteriori(buffer, is_valid)
+        if self.batched:
+            self.history.push(buffer)
+            self.history_end += len(buffer)
+        return buffer
 
     def _predict(self, buffer: np.ndarray):
         '''
         '''
+        if self.batched:
+            return self._predict_reconstructed_buffer_batched(buffer)
         return self._predict_reconstructed_buffer(buffer)
 
     def _compute_spectrogram(self, context, fs):
@@ -358,3 +442,48 @@ class DeepLearningPLC(PLCAlgorithm):
             last_packet = np.expand_dims(context[-self.packet_size:, channel_index], axis=0)
             reconstructed_buffer[channel_index, :] = self.model((spectrograms, last_packet))
         return reconstructed_buffer.T
+
+    def _get_downsampled_context(self) -> np.ndarray:
+        '''
+        This function returns the context resampled to fs_dl. The resampled
+        samples that no longer depend on future input are stored in context_dl
+        and never computed again: only the samples received since the previous
+        call (plus the length of the resampling filter) are resampled.
+        '''
+        history = self.history.get()
+        history_start = self.history_end - len(history)
+        # The output sample j of the resampled stream is centred on the input sample j*down/up
+        # and it is settled when the input samples up to j*down/up + half_length have been received.
+        settled_end = max((self.history_end - self.half_length) * self.up // self.down, 0)
+        block_start = (self.context_dl_end * self.down // self.up - self.half_length) // self.down * self.down
+        if block_start < history_start:
+            # The input needed to resume the resampled stream has already been discarded
+            block_start = -(-history_start // self.down) * self.down
+            self.context_dl_end = block_start * self.up // self.down
+        resampled = resample_poly(history[block_start - history_start:], self.up, self.down, axis=0)
+        resampled_start = block_start * self.up // self.down
+        if settled_end > self.context_dl_end:
+            self.context_dl.push(resampled[self.context_dl_end - resampled_start:settled_end - resampled_start])
+            self.context_dl_end = settled_end
+        tail = resampled[self.context_dl_end - resampled_start:]
+        return np.concatenate((self.context_dl.get(), tail))[-len(self.context_dl.get()):]
+
+    def _compute_spectrograms(self, contexts: np.ndarray) -> np.ndarray:
+        '''
+        This function computes the mel spectrograms of several contexts at once
+        with the same parameters of _compute_spectrogram.
+
+            Inputs:
+                contexts:   array of shape (n_contexts, n_samples).
+        '''
+        contexts = np.pad(contexts, ((0, 0), (0, self.window_length - self.hop_size)))
+        frames = sliding_window_view(contexts, self.window_length, axis=-1)[:, ::self.hop_size] * self.window
+        power_spectrograms = np.abs(np.fft.rfft(frames, axis=-1)) ** 2
+        return np.einsum('mf,ctf->cmt', self.mel_basis, power_spectrograms)
+
+    def _predict_reconstructed_buffer_batched(self, buffer):
+        context = self._get_downsampled_context()
+        spectrograms = self._compute_spectrograms(context[-round(self.context_length_samples/4):].T)
+        last_packets = context[-self.packet_size:].T
+        reconstructed_buffer = np.asarray(self.model((spectrograms, last_packets)))
+        return np.reshape(reconstructed_buffer, np.shape(buffer.T)).T
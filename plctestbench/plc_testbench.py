@@ -52,6 +52,43 @@ class PLCTestbench(object):
         self.data_manager.run_testbench()
         print("testbench.run finished!")
 
+    def plan(self):
+        '''
+        Print and return the execution plan of the testbench without running
+        it: the nodes to compute and to reuse, the estimated CPU time of each
+        worker and the estimated disk usage.
+        '''
+        plan = self.data_manager.plan_execution(estimate=True)
+        print(plan)
+        return plan
+
+    def extend(self, original_audio_tracks: list | None = None,
+               packet_loss_simulators: list | None = None,
+               plc_algorithms: list | None = None,
+               output_analysers: list | None = None) -> None:
+        '''
+        Add new workers to the run and run only the nodes using them. The run
+        keeps its id.
+        '''
+        subtrees = self.data_manager.add_workers(original_audio_tracks,
+                                                 packet_loss_simulators,
+                                                 plc_algorithms,
+                                                 output_analysers)
+        self.data_manager.run_testbench(subtrees)
+        print("testbench.extend finished!")
+
+    def collect_garbage(self) -> tuple:
+        '''
+        Delete the files of the artifact store that are not used by any node
+        stored in the databases sharing it. It returns the number of deleted
+        files and the bytes freed.
+        '''
+        if self.data_manager.artifact_store is None:
+            raise ValueError("The artifact store is not enabled.")
+        deleted_files, freed_bytes = self.data_manager.artifact_store.gc()
+        print("Deleted %d files (%.1f MB)" % (deleted_files, freed_bytes / 1e6))
+        return deleted_files, freed_bytes
+
     def plot(self, plot_settings={}, show=True, to_file=False, original_tracks=False, lost_samples_masks=False, reconstructed_tracks=False, output_analyses=False, group=False, peaq_summary=False) -> None:
         '''
         Plot all the results
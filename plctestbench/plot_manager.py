@@ -6,7 +6,7 @@ import numpy as np
 
 from .node import ReconstructedTrackNode, Node, OriginalTrackNode, LostSamplesMaskNode, OutputAnalysisNode
 from .output_analyser import SimpleCalculator, MSECalculator, MAECalculator, SpectralEnergyCalculator, PEAQCalculator, WindowedPEAQCalculator, PerceptualCalculator, HumanCalculator
-from .file_wrapper import SimpleCalculatorData
+from .file_wrapper import SimpleCalculatorData, LostSamplesMask
 
 class PlotManager(object):
 
@@ -68,7 +68,7 @@ class PlotManager(object):
         Plot the lost samples mask data
         '''
         packet_size = node.get_setting("packet_size")
-        lost_packets_idx = node.get_file().get_data()[::packet_size]/packet_size
+        lost_packets_idx = LostSamplesMask.from_data(node.get_file().get_data(), packet_size).get_lost_packets_idx()
         original_track = node.get_original_track()
         samplerate = original_track.get_samplerate()
         original_track_length = (len(original_track.get_data()) - 1)/samplerate
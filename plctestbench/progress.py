@@ -0,0 +1,158 @@
+import time
+import logging
+from plctestbench.utils import tqdm
+
+# Kinds of the events emitted by the DataManager
+NODE_STARTED = 'node_started'
+NODE_FINISHED = 'node_finished'
+
+class ProgressEvent(object):
+    '''
+    This class describes the start or the end of the run of a node.
+
+        Variables:
+            kind:       NODE_STARTED or NODE_FINISHED.
+            node:       the node.
+            node_id:    the id of the node.
+            node_type:  the name of the class of the node.
+            worker:     the name of the worker of the node.
+            metrics:    the metrics of the run, see Node._measure_run, only
+                        for NODE_FINISHED events. metrics["cache"] tells
+                        whether the node was loaded from the database.
+            time:       the time of the event, in seconds since the epoch.
+    '''
+    def __init__(self, kind: str, node, metrics: dict | None = None) -> None:
+        self.kind = kind
+        self.node = node
+        self.node_id = node.get_id()
+        self.node_type = type(node).__name__
+        self.worker = str(node.get_worker())
+        self.metrics = metrics
+        self.time = time.time()
+
+    def is_cache_hit(self) -> bool:
+        return self.metrics is not None and self.metrics.get("cache") == "hit"
+
+    def __str__(self) -> str:
+        description = self.kind + ": " + self.node_type + " " + self.worker + " (" + self.node_id + ")"
+        if self.metrics is not None:
+            description += " - cache " + str(self.metrics.get("cache")) + ", %.3f s" % self.metrics.get("wall_time", 0.)
+        return description
+
+class SilentProgressBar(object):
+    '''
+    This class has the interface of a tqdm progress bar, without displaying
+    anything. It can be used both to wrap an iterable and as a bar created
+    with a total and advanced with update.
+    '''
+    def __init__(self, iterable=None, desc=None, total=None, **kwargs) -> None:
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable) #type: ignore
+
+    def update(self, n=1) -> None:
+        pass
+
+    def set_description(self, desc) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class ProgressSink(object):
+    '''
+    This class receives the progress of a run. It is passed to the
+    testbench as the 'progress_monitor' setting.
+
+    Called with a worker (or with the DataManager), it returns the factory
+    of the progress bars of the caller, with the interface of tqdm. The
+    events describing the start and the end of the run of every node are
+    passed to emit. Neither the bars nor the events wait for anything, so
+    a sink never slows down a run.
+    '''
+    def __call__(self, caller):
+        return SilentProgressBar
+
+    def emit(self, event: ProgressEvent) -> None:
+        pass
+
+class FactoryProgressSink(ProgressSink):
+    '''
+    This class displays the progress bars created by a progress monitor
+    factory, i.e. a function that returns the class of the bars of a
+    caller (e.g. lambda caller: tqdm). A completed bar is displayed for the
+    nodes loaded from the database, whose workers are not run.
+    '''
+    def __init__(self, progress_monitor) -> None:
+        self.progress_monitor = progress_monitor
+
+    def __call__(self, caller):
+        return self.progress_monitor(caller)
+
+    def emit(self, event: ProgressEvent) -> None:
+        if event.kind == NODE_FINISHED and event.is_cache_hit():
+            progress_bar = self.progress_monitor(event.node.get_worker())(total=1, desc=event.worker)
+            progress_bar.update(1)
+            progress_bar.close()
+
+class TqdmProgressSink(FactoryProgressSink):
+    '''
+    This class displays the progress with tqdm. It is the default sink.
+    '''
+    def __init__(self) -> None:
+        super().__init__(lambda caller: tqdm)
+
+class LoggingProgressSink(ProgressSink):
+    '''
+    This class logs the events of a run, so that its progress can be
+    followed without a terminal (e.g. in a batch job).
+
+        Inputs:
+            logger:             the logger, 'plctestbench' by default.
+            level:              the level of the log records.
+            progress_monitor:   the factory of the progress bars of the
+                                workers, see FactoryProgressSink. By default
+                                no bar is displayed.
+    '''
+    def __init__(self, logger: logging.Logger | None = None, level: int = logging.INFO, progress_monitor=None) -> None:
+        self.logger = logger if logger is not None else logging.getLogger('plctestbench')
+        self.level = level
+        self.progress_monitor = progress_monitor
+
+    def __call__(self, caller):
+        return self.progress_monitor(caller) if self.progress_monitor is not None else SilentProgressBar
+
+    def emit(self, event: ProgressEvent) -> None:
+        self.logger.log(self.level, str(event))
+
+class CallbackProgressSink(ProgressSink):
+    '''
+    This class passes the events of a run to a function, e.g. to update a
+    user interface.
+
+        Inputs:
+            callback:           the function called with every ProgressEvent.
+            progress_monitor:   the factory of the progress bars of the
+                                workers, see FactoryProgressSink. By default
+                                no bar is displayed.
+    '''
+    def __init__(self, callback, progress_monitor=None) -> None:
+        self.callback = callback
+        self.progress_monitor = progress_monitor
+
+    def __call__(self, caller):
+        return self.progress_monitor(caller) if self.progress_monitor is not None else SilentProgressBar
+
+    def emit(self, event: ProgressEvent) -> None:
+        self.callback(event)
+
+def as_progress_sink(progress_monitor) -> ProgressSink:
+    '''
+    This function returns the given progress monitor as a ProgressSink: the
+    progress monitor factories used before the sinks were introduced are
+    wrapped in a FactoryProgressSink.
+    '''
+    if isinstance(progress_monitor, ProgressSink):
+        return progress_monitor
+    return FactoryProgressSink(progress_monitor)
@@ -1,60 +1,81 @@
+import re
 from enum import Enum
 from inspect import isclass
 from typing import List, Dict
 from copy import deepcopy
 
-from plctestbench.utils import compute_hash, get_class, relative_to_root
+from plctestbench.utils import compute_digest, get_class, register_class, relative_to_root
+
+# Version of the detection of the bursts of lost packets around which the
+# neighbourhoods of the losses are analysed, see utils.extract_intorni. It is
+# stored in the settings of the analysers using it, so that the results of a
+# previous version are not reused.
+BURST_DETECTION_VERSION = 2
+
+# Version of the context of the PLC algorithms, see PLCAlgorithm.context. It
+# is stored in the settings of the algorithms using more than the last packet
+# of the context, so that the reconstructions of a previous version, which
+# only kept the last packet, are not reused.
+CONTEXT_VERSION = 2
 
 class Settings(object):
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        register_class(cls)
+
     def __init__(self, settings: dict = {}) -> None:
         self.settings = self.from_dict(settings)
+        self.parent_settings = None
+        self._invalidate()
 
     def from_dict(self, settings_dict):
         '''
-        This method is used to convert a dictionary back to settings.
+        This method is used to convert a dictionary back to settings. The
+        suffixes of each key (see to_dict) are resolved in a single pass.
         '''
-        def reconstruct_values(key, value):
-            special_chars = list(filter(lambda x: x in ['-', '~', '&', '$', '#'], list(str(key))))
-            last_special_char = special_chars[-1] if len(special_chars) > 0 else None
-            if last_special_char == '-':
-                key, class_name = key.split('-')
-                new_value = value
-                clazz = get_class(class_name)
+        def reconstruct_value(suffixes, value):
+            # The class of the value is given by the last suffix
+            if len(suffixes) > 0 and suffixes[-1][0] == '-':
+                clazz = get_class(suffixes[-1][1:])
                 if Settings in clazz.__mro__:
-                    new_value = clazz()
-                    new_value.settings = self.from_dict(value)
+                    new_value = Settings(value)
+                    new_value.__class__ = clazz
+                    value = new_value
                 else:
-                    new_value = get_class(class_name)(value)
-                return key, new_value
-            elif last_special_char == '~':
-                key, idx = key.split('~')
-                return key, [value]
-            elif last_special_char == '&':
-                key, idx = key.split('&')
-                return key, (value)
-            elif last_special_char == '$':
-                key, subkey = key.split('$')
-                return key, {subkey: value}
-            elif last_special_char == '#':
-                key = key.rstrip('#')
-                return key, globals()[value]
-            else:
-                return key, value
+                    value = clazz(value)
+                suffixes = suffixes[:-1]
+            elif len(suffixes) > 0 and suffixes[-1][0] == '#':
+                value = globals()[value]
+                suffixes = suffixes[:-1]
+            # The containers are nested from the first suffix to the last one
+            for suffix in reversed(suffixes):
+                if suffix[0] == '~':
+                    value = [value]
+                elif suffix[0] == '&':
+                    value = (value,)
+                elif suffix[0] == '$':
+                    value = {suffix[1:]: value}
+            return value
+
+        def merge_values(current_value, new_value):
+            if isinstance(current_value, (list, tuple)) and isinstance(new_value, type(current_value)):
+                return current_value + new_value
+            if isinstance(current_value, dict) and isinstance(new_value, dict):
+                for subkey, subvalue in new_value.items():
+                    current_value[subkey] = merge_values(current_value[subkey], subvalue) if subkey in current_value else subvalue
+                return current_value
+            return new_value
 
         new_settings = {}
         for key, value in settings_dict.items():
-            new_key, new_value = reconstruct_values(key, value)
-            if new_key in new_settings and isinstance(new_settings[new_key], list):
-                new_settings[new_key] += new_value
-            elif new_key in new_settings and isinstance(new_settings[new_key], tuple):
-                new_settings[new_key] = new_settings[new_key] + (new_value,)
-            elif new_key in new_settings and isinstance(new_settings[new_key], dict):
-                new_settings[new_key].update(new_value)
-            else:
-                new_settings[new_key] = new_value
+            tokens = re.split(r'([-~&$#])', str(key))
+            new_key = tokens[0]
+            suffixes = [tokens[idx] + tokens[idx + 1] for idx in range(1, len(tokens), 2)]
+            new_value = reconstruct_value(suffixes, value)
+            new_settings[new_key] = merge_values(new_settings[new_key], new_value) if new_key in new_settings else new_value
 
-        return new_settings if new_settings.keys() == settings_dict.keys() else self.from_dict(new_settings)
+        return new_settings
 
     def set_progress_monitor(self, progress_monitor):
         '''
@@ -71,19 +92,34 @@ class Settings(object):
         '''
         return self.progress_monitor
 
+    def derive(self):
+        '''
+        This method returns a new layer of the settings, to be used by a
+        node. The values are shared with the original settings, which are not
+        changed by the keys added to the layer nor by inherit_from.
+        '''
+        derived = object.__new__(self.__class__)
+        derived.__dict__.update(self.__dict__)
+        derived.settings = self.settings.copy()
+        return derived
+
     def inherit_from(self, parent_settings):
         '''
         This method is used to inherit the settings from the parent node.
+        The settings of the parent are looked up through a reference to it
+        instead of being copied.
 
             Input:
                 parent_settings:    the parent Settings object.
         '''
-        for key, value in parent_settings.get_all().items():
-            if key != self:
-                self.add(key, value)
+        for key in self.settings:
+            if parent_settings.has(key):
+                raise KeyError(f"The key {key} is already present in the settings.")
+        self.parent_settings = parent_settings
 
         # Save parent hash to use in __hash__ method
         self.parent = str(hash(parent_settings))
+        self._invalidate()
 
         # Save progress_monitor
         self.set_progress_monitor(parent_settings.get_progress_monitor())
@@ -96,10 +132,26 @@ class Settings(object):
                 key:    the key of the setting to be added.
                 value:  the value of the setting to be added.
         '''
-        if key in self.settings:
+        if self.has(key):
             raise KeyError(f"The key {key} is already present in the settings.")
 
         self.settings[key] = value
+        self._invalidate()
+
+    def has(self, key):
+        '''
+        This method returns True if the setting is present, either in these
+        settings or in the ones they inherit from.
+
+            Input:
+                key:    the key of the setting.
+        '''
+        settings = self
+        while settings is not None:
+            if key in settings.settings:
+                return True
+            settings = settings.parent_settings
+        return False
 
     def get(self, key):
         '''
@@ -108,21 +160,76 @@ class Settings(object):
             Input:
                 key:    the key of the setting to be retrieved.
         '''
-        if key not in self.settings:
-            raise KeyError(f"The key {key} is not present in the settings.")
-
-        return self.settings[key]
+        settings = self
+        while settings is not None:
+            if key in settings.settings:
+                return settings.settings[key]
+            settings = settings.parent_settings
+        raise KeyError(f"The key {key} is not present in the settings.")
 
     def get_all(self):
         '''
-        This method is used to retrieve all the settings.
+        This method is used to retrieve all the settings, including the
+        inherited ones.
         '''
-        return self.settings
+        if self.parent_settings is None:
+            return self.settings
+        all_settings = self.settings.copy()
+        all_settings.update(self.parent_settings.get_all())
+        return all_settings
 
     def to_dict(self):
         '''
-        This method is used to convert the settings to a dictionary.
-        ''' 
+        This method is used to convert the settings to a dictionary. The
+        dictionary of the own settings is computed once and cached until they
+        change, the inherited ones are converted by the parent settings.
+        '''
+        settings_dict, converted_dict = self._get_dicts()
+        settings_dict.update(converted_dict)
+        return settings_dict
+
+    def _get_dicts(self):
+        '''
+        This method returns the settings that are stored as they are and the
+        converted ones, including the inherited ones, see _build_dicts. The
+        converted settings follow all the others, as when the inherited
+        settings were copied into the child settings.
+        '''
+        if getattr(self, '_dict', None) is None:
+            self._dict = self._build_dicts()
+        settings_dict, converted_dict = self._dict[0].copy(), self._dict[1].copy() #type: ignore
+        if self.parent_settings is not None:
+            parent_settings_dict, parent_converted_dict = self.parent_settings._get_dicts()
+            settings_dict.update(parent_settings_dict)
+            converted_dict.update(parent_converted_dict)
+        return settings_dict, converted_dict
+
+    def get_serialization(self) -> bytes:
+        '''
+        This method returns the canonical serialization of the settings, from
+        which their hash is computed. It is invariant with respect to the
+        order of the keys and it is cached until the settings change.
+        '''
+        if getattr(self, '_serialization', None) is None:
+            string = str(self) + str(self.parent) if hasattr(self, "parent") else str(self)
+            self._serialization = string.encode('utf-8')
+        return self._serialization #type: ignore
+
+    def _invalidate(self):
+        '''
+        This method discards the cached dictionary, serialization and hash of
+        the settings. It has to be called whenever the settings change.
+        '''
+        self._dict = None
+        self._serialization = None
+        self._digest = None
+
+    def _build_dicts(self):
+        '''
+        This method converts the own settings to a dictionary, see to_dict.
+        The settings that are stored as they are and the converted ones are
+        returned separately.
+        '''
         def parse_values(key, value, to_delete: list = [], to_add: dict = {}):
             new_dict_entry: dict = {}
             if isinstance(value, Settings):
@@ -164,8 +271,7 @@ class Settings(object):
             parse_values(key, value, to_delete, to_add)
         for key in to_delete:
             del settings_dict[key]
-        settings_dict.update(to_add)
-        return settings_dict
+        return settings_dict, to_add
     
     def clone(self):
         return deepcopy(self)
@@ -208,6 +314,7 @@ class Settings(object):
         
         if (change_callback and callable(change_callback)):
             change_callback(cloned_settings)
+        cloned_settings._invalidate()
         
         cloned_settings.__validate__()
         return cloned_settings
@@ -218,10 +325,11 @@ class Settings(object):
     def __hash__(self):
         '''
         This method returns the hash of the settings. It is invariant with respect
-        to the order of the keys.
+        to the order of the keys and it is cached until the settings change.
         '''
-        string = str(self) + str(self.parent) if hasattr(self, "parent") else str(self)
-        return compute_hash(string)
+        if getattr(self, '_digest', None) is None:
+            self._digest = compute_digest(self.get_serialization())
+        return self._digest
 
     def __str__(self):
         return self.__repr__()
@@ -244,6 +352,7 @@ class Settings(object):
         '''
         settings_copy = Settings(self.settings.copy())
         settings_copy.set_progress_monitor(self.get_progress_monitor())
+        settings_copy.parent_settings = self.parent_settings
         settings_copy.__class__ = self.__class__
         return settings_copy
 
@@ -261,6 +370,7 @@ class OriginalAudioSettings(Settings):
 
     def set_fs(self, fs):
         self.settings["fs"] = fs
+        self._invalidate()
 
 
 class BinomialPLSSettings(Settings):
@@ -646,6 +756,7 @@ class BurgPLCSettings(PLCSettings):
         super().__init__(crossfade, fade_in, crossfade_frequencies, crossover_order)
         self.settings["context_length"] = context_length
         self.settings["order"] = order
+        self.settings["context_version"] = CONTEXT_VERSION
 
         self.__validate__()
 
@@ -680,7 +791,8 @@ class DeepLearningPLCSettings(PLCSettings):
                        window_length: int = 160*3,
                        lower_edge_hertz: float = 40.0,
                        upper_edge_hertz: float = 7600.0,
-                       num_mel_bins: int = 100):
+                       num_mel_bins: int = 100,
+                       batched: bool = False):
         '''
         This class containes the settings for the DeepLearningPLC class.
 
@@ -693,6 +805,8 @@ class DeepLearningPLCSettings(PLCSettings):
                 lower_edge_hertz:   lower edge of the tracks.
                 upper_edge_hertz:   upper edge of the tracks.
                 num_mel_bins:       number of mel bins of the tracks.
+                batched:            keep the downsampled context up to date incrementally
+                                    and predict all the channels with a single call to the model.
         '''
         super().__init__(crossfade, fade_in, crossfade_frequencies, crossover_order)
         self.settings["model_path"] = str(relative_to_root(model_path))
@@ -704,6 +818,10 @@ class DeepLearningPLCSettings(PLCSettings):
         self.settings["lower_edge_hertz"] = lower_edge_hertz
         self.settings["upper_edge_hertz"] = upper_edge_hertz
         self.settings["num_mel_bins"] = num_mel_bins
+        self.settings["context_version"] = CONTEXT_VERSION
+        # Only the batched mode is stored, so that the ids of the existing nodes do not change
+        if batched:
+            self.settings["batched"] = batched
 
         self.__validate__()
 
@@ -760,11 +878,19 @@ class AdvancedPLCSettings(PLCSettings):
             for settings in band_settings:
                 settings.set_progress_monitor(self.progress_monitor)
 
+    def derive(self):
+        derived = super().derive()
+        # The band settings inherit from the parent too, so they are layered as well
+        derived.settings["settings"] = {key: [settings.derive() for settings in band_settings] for key, band_settings in self.settings["settings"].items()}
+        return derived
+
     def inherit_from(self, parent_settings):
         super().inherit_from(parent_settings)
         for band_settings in self.settings["settings"].values():
             for settings in band_settings:
                 settings.inherit_from(parent_settings)
+        # The dictionary includes the ones of the band settings
+        self._invalidate()
     
     def set_frequencies(self, frequencies: "dict[str, list[int]]") -> Settings:
         def change_callback(cloned_settings):
@@ -913,6 +1039,7 @@ class WindowedPEAQCalculatorSettings(Settings):
         super().__init__()
         self.settings["peaq_mode"] = peaq_mode
         self.settings["intorno_length"] = intorno_length
+        self.settings["burst_detection_version"] = BURST_DETECTION_VERSION
 
 
 class PerceptualCalculatorSettings(Settings):
@@ -942,6 +1069,7 @@ class PerceptualCalculatorSettings(Settings):
         self.settings["masking_offset"] = masking_offset
         self.settings["db_weighting"] = db_weighting
         self.settings["metric"] = metric
+        self.settings["burst_detection_version"] = BURST_DETECTION_VERSION
 
 
 class HumanCalculatorSettings(Settings):
@@ -963,6 +1091,7 @@ class HumanCalculatorSettings(Settings):
         self.settings["choose_seed"] = choose_seed
         self.settings["reference"] = reference
         self.settings["anchor"] = anchor
+        self.settings["burst_detection_version"] = BURST_DETECTION_VERSION
 
 
 class PlotsSettings(Settings):
@@ -1,9 +1,13 @@
 import sys
 import hashlib
-from time import sleep
+try:
+    import resource
+except ImportError:
+    resource = None
 import numpy as np
 from pathlib import Path
 from typing import Callable
+from importlib.metadata import entry_points
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 
@@ -25,32 +29,95 @@ def _is_notebook() -> bool:
 
 
 # Conditional import of tqdm.
-# The progress_monitor alias is used to display progress bars
-# and it can be overridden by the user before running the testbench.
+# The progress bars are displayed by the sinks defined in the progress module.
 if _is_notebook():
     from tqdm.notebook import tqdm
-    DUMMY_BAR_SLEEP = 0
 else:
     from tqdm import tqdm
-    DUMMY_BAR_SLEEP = 0.1
-progress_monitor = lambda caller: tqdm
 
 
+# Classes retrieved by name by get_class. The workers and the settings
+# register themselves when they are defined, the classes provided by other
+# packages are registered through the CLASS_ENTRY_POINT_GROUP entry points.
+CLASS_ENTRY_POINT_GROUP = 'plctestbench.classes'
+_class_registry = {}
+_entry_points_loaded = False
+
+def register_class(clazz, name=None):
+    '''
+    This function registers a class, so that get_class retrieves it by its
+    name (or by the given one). It returns the class, so that it can be used
+    as a decorator.
+    '''
+    _class_registry[name if name is not None else clazz.__name__] = clazz
+    return clazz
+
+def _load_entry_points() -> None:
+    '''
+    This function registers the classes provided by the entry points of the
+    installed packages, the first time it is called.
+    '''
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    for entry_point in entry_points(group=CLASS_ENTRY_POINT_GROUP):
+        register_class(entry_point.load(), entry_point.name)
+
 def get_class(class_name):
     '''
-    This function returns the class with the given name.
+    This function returns the class with the given name. The classes that
+    are not registered (e.g. the enumerations) are looked up in the modules
+    of plctestbench and registered, so they are looked up only once.
     '''
-    for module_name, module in sys.modules.items():
+    if class_name in _class_registry:
+        return _class_registry[class_name]
+    for module_name, module in list(sys.modules.items()):
         if module_name.startswith('plctestbench'):
             if hasattr(module, class_name):
-                return getattr(module, class_name)
+                return register_class(getattr(module, class_name), class_name)
+    _load_entry_points()
+    if class_name in _class_registry:
+        return _class_registry[class_name]
     raise ValueError(f"The class {class_name} does not exist.")
 
 def compute_hash(obj):
     '''
     This function returns the hash of the given object.
     '''
-    return int.from_bytes(hashlib.md5(str(obj).encode('utf-8')).digest()[:7], 'little')
+    return compute_digest(str(obj).encode('utf-8'))
+
+def compute_digest(data: bytes) -> int:
+    '''
+    This function returns the hash of the given bytes.
+    '''
+    return int.from_bytes(hashlib.md5(data).digest()[:7], 'little')
+
+def get_peak_rss() -> int | None:
+    '''
+    This function returns the peak resident set size of the process in bytes,
+    or None if it is not available on the current platform.
+    '''
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def get_io_counters() -> dict | None:
+    '''
+    This function returns the number of bytes read and written by the
+    process through system calls (the rchar and wchar counters of
+    /proc/self/io), or None if /proc/self/io is not available. They count
+    the sockets and the pipes too (e.g. the traffic with MongoDB), whether
+    or not the storage is accessed, and leave out the memory-mapped files.
+    '''
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+    except (OSError, ValueError):
+        return None
+    return {"syscall_read_bytes": int(counters['rchar']), "syscall_write_bytes": int(counters['wchar'])}
 
 def escape_email(email):
     '''
@@ -60,10 +127,12 @@ def escape_email(email):
 
 def dummy_progress_bar(worker):
     '''
-    This function is used to create a dummy progress bar.
+    This function is used to display a completed progress bar for the
+    workers that do not report their progress.
     '''
-    for _ in worker.progress_monitor(range(10), desc=str(worker)):
-        sleep(DUMMY_BAR_SLEEP)
+    progress_bar = worker.progress_monitor(total=1, desc=str(worker))
+    progress_bar.update(1)
+    progress_bar.close()
 
 def recursive_split_audio(audio: np.ndarray, xovers: list, bands: list = []) -> list:
         lp_audio, hp_audio = xovers[0].split(audio)
@@ -79,41 +148,53 @@ def force_2d(arr):
         arr = np.expand_dims(arr, axis=-1)
     return arr
 
+class CompositeProgressMonitor(object):
+    '''
+    This class forwards the progress of the workers nested in another worker
+    (e.g. the PLC algorithms of AdvancedPLC) to the progress bar of the
+    latter. It can be used both to wrap an iterable and, like tqdm, as a bar
+    created with a total and advanced with update.
+    '''
+    def __init__(self, progress_monitor) -> None:
+        self.progress_monitor = progress_monitor
+
+    def __call__(self, iterable=None, desc=None, total=None):
+        if iterable is None:
+            return self
+        return self._wrap(iterable)
+
+    def _wrap(self, iterable):
+        for item in iterable:
+            self.progress_monitor.update(1)
+            yield item
+
+    def update(self, n=1) -> None:
+        self.progress_monitor.update(n)
+
+    def set_description(self, desc) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
 def prepare_progress_monitor(progress_monitor) -> Callable:
-            def composite_progress_monitor(iterable, desc):
-                    for item in iterable:
-                        progress_monitor.update(1)
-                        yield item
-            return composite_progress_monitor
+    return CompositeProgressMonitor(progress_monitor)
 
 def relative_to_root(path):
     return PROJECT_ROOT.joinpath(path)
 
-def extract_intorni(audio_file, lost_samples_idxs, intorno_size, fs, packet_size, unique=False):
-    def find_boundary_indexes(lost_samples_idxs):
-        boundary_indexes = []
-        start_idx = None
-        end_idx = None
-        for idx in lost_samples_idxs:
-            end_idx = idx
-            if start_idx is None:
-                start_idx = idx
-            elif idx == end_idx + 1:
-                end_idx = idx
-            else:
-                boundary_indexes.append((start_idx, end_idx))
-                start_idx = None
-            if idx == lost_samples_idxs[-1]:
-                boundary_indexes.append((start_idx, end_idx))
-        return boundary_indexes
-
+def extract_intorni(audio_file, lost_samples_mask, intorno_size, fs, packet_size, unique=False):
+    '''
+    This function extracts from the audio file a neighbourhood of
+    intorno_size milliseconds centred on each burst of lost packets
+    of lost_samples_mask (a LostSamplesMask).
+    '''
     intorno_samples = float(intorno_size*fs)/1000
     audio_data = audio_file.get_data()
-    boundary_indexes = find_boundary_indexes(lost_samples_idxs)
     intorni = []
     packet_idxs = []
-    for start_idx, end_idx in boundary_indexes:
-        center_idx = (start_idx + end_idx) // 2
+    for start_idx, end_idx in lost_samples_mask.sample_bursts():
+        center_idx = (start_idx + end_idx - 1) // 2
         start_sample = int(center_idx - intorno_samples // 2)
         end_sample = int(center_idx + intorno_samples // 2)
         intorno = audio_data[start_sample:end_sample]
@@ -126,19 +207,18 @@ def extract_intorni(audio_file, lost_samples_idxs, intorno_size, fs, packet_size
         packet_idxs.append(int(center_idx//packet_size))
     return packet_idxs, intorni
 
-def force_single_loss_per_stimulus(lost_samples_idxs, fs, spacing, samples_per_packet):
+def force_single_loss_per_stimulus(lost_samples_mask, fs, spacing, samples_per_packet):
 
     # TODO: Allow for consecutive lost packets. This solution will discard any subsequent lost packets.
-    selected_idxs = []
+    selected_packet_idxs = []
     prev_packet_idx = -1
     
-    for idx in lost_samples_idxs:
-        packet_idx = idx // samples_per_packet
-        if prev_packet_idx == -1 or (packet_idx - prev_packet_idx) >= spacing/1000 * fs / samples_per_packet or packet_idx == prev_packet_idx:
-            selected_idxs.append(idx)
+    for packet_idx in lost_samples_mask.get_lost_packets_idx().tolist():
+        if prev_packet_idx == -1 or (packet_idx - prev_packet_idx) >= spacing/1000 * fs / samples_per_packet:
+            selected_packet_idxs.append(packet_idx)
             prev_packet_idx = packet_idx
     
-    return selected_idxs
+    return type(lost_samples_mask).from_lost_packets_idx(selected_packet_idxs, samples_per_packet, lost_samples_mask.get_num_samples())
 
 def fade_in(audio, fs, fade_in_time) -> None:
     fade_in_samples = int(fade_in_time * fs / 1000)
@@ -1,7 +1,11 @@
 from plctestbench.settings import Settings
-from plctestbench.utils import dummy_progress_bar
+from plctestbench.utils import dummy_progress_bar, register_class
 
 class Worker(object):
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        register_class(cls)
+
     def __init__(self, settings: Settings) -> None:
         self.settings = settings
         self.persistent = True
@@ -0,0 +1,77 @@
+import os
+import atexit
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class WriteBehindQueue(object):
+    '''
+    This class runs the writes of the files and of the database documents on
+    a single background thread, so that they overlap with the computation of
+    the following nodes. The writes are performed in the same order they are
+    submitted: a document submitted after the write of its file is stored
+    only once the file is on disk.
+    '''
+    def __init__(self) -> None:
+        self.executor = None
+        self.futures = []
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args) -> Future:
+        '''
+        This function queues a call of function with the given arguments and
+        returns its future.
+        '''
+        with self.lock:
+            # The thread of the executor is not inherited by forked processes
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='write_behind')
+                self.futures = []
+                self.pid = os.getpid()
+            future = self.executor.submit(function, *args)
+            self.futures.append(future)
+            return future
+
+    def flush(self) -> None:
+        '''
+        This function waits for all the queued writes to be completed and
+        raises the first exception raised by them, if any.
+        '''
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            futures, self.futures = self.futures, []
+        error = None
+        for future in futures:
+            try:
+                future.result()
+            except BaseException as e:
+                error = e if error is None else error
+        if error is not None:
+            raise error
+
+    def reset_after_fork(self) -> None:
+        '''
+        This function is called in a forked process before submitting any
+        write: the lock may have been held by another thread of the parent
+        when the process was forked, and the thread of the executor is not
+        inherited.
+        '''
+        self.lock = threading.Lock()
+        self.executor = None
+        self.futures = []
+        self.pid = os.getpid()
+
+# Queue shared by the whole process
+write_behind_queue = WriteBehindQueue()
+
+def submit(function, *args) -> Future:
+    return write_behind_queue.submit(function, *args)
+
+def flush() -> None:
+    write_behind_queue.flush()
+
+def reset_after_fork() -> None:
+    write_behind_queue.reset_after_fork()
+
+atexit.register(flush)